@@ -6,7 +6,7 @@ import logging
 import re
 import json
 import time
-from sonrai import SonraiApi
+from sonrai import SonraiApi, SonraiApiException
 
 
 # build the required arguments for the script
@@ -431,4 +431,8 @@ def handle(myargv):
 
 
 if __name__ == "__main__":
-    handle(sys.argv[1:])
+    try:
+        handle(sys.argv[1:])
+    except SonraiApiException as e:
+        logging.error(str(e))
+        sys.exit(e.exitCode)
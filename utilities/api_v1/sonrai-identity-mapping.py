@@ -364,6 +364,10 @@ def handle(myargv):
    HANDLER.main(myargv)
 
 if __name__ == "__main__":
-   handle(sys.argv[1:])
+   try:
+      handle(sys.argv[1:])
+   except sonrai.SonraiApiException as e:
+      logging.error(str(e))
+      sys.exit(e.exitCode)
 
 
@@ -20,7 +20,7 @@ import os
 import json
 import getopt
 import re
-from sonrai import SonraiApi
+from sonrai import SonraiApi, SonraiApiException
 
 class policyDiff:
 
@@ -225,4 +225,8 @@ def handle(myargv):
     HANDLER.main()
 
 if __name__ == "__main__":
-    handle(sys.argv[1:])
+    try:
+        handle(sys.argv[1:])
+    except SonraiApiException as e:
+        logging.error(str(e))
+        sys.exit(e.exitCode)
@@ -21,7 +21,7 @@ import getopt
 import json
 import time
 from datetime import datetime
-from sonrai import SonraiApi
+from sonrai import SonraiApi, SonraiApiException
 
 class ResourceQuery:
 
@@ -419,4 +419,8 @@ def handle(myargv):
     HANDLER.main(myargv)
 
 if __name__ == "__main__":
-    handle(sys.argv[1:])
+    try:
+        handle(sys.argv[1:])
+    except SonraiApiException as e:
+        logging.error(str(e))
+        sys.exit(e.exitCode)
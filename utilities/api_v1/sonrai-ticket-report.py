@@ -19,7 +19,7 @@ import sys, logging
 import os
 import re
 import getopt
-from sonrai import SonraiApi
+from sonrai import SonraiApi, SonraiApiException
 
 class TicketQuery:
 
@@ -280,4 +280,8 @@ def handle(myargv):
     HANDLER.main()
 
 if __name__ == "__main__":
-    handle(sys.argv[1:])
+    try:
+        handle(sys.argv[1:])
+    except SonraiApiException as e:
+        logging.error(str(e))
+        sys.exit(e.exitCode)
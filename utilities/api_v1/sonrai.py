@@ -24,29 +24,180 @@
 # TOKENSTORE: Directory in which to store the refreshed auth token
 # TOKENFILE:  Filename to use to store the refreshed auth token
 # LOGLEVEL:       Set to True if you would like debugging messages
-
-import sys
+# SAVEDQUERYCACHETTL: Seconds to reuse saved query results from disk (0, the default, disables the cache)
+# SAVEDQUERYCACHEDIR: Directory for the saved query result cache (default <TOKENSTORE>/cache)
+# SONRAI_API_CASSETTE: Gzip file to record responses to, or replay them from (see SonraiCassette)
+# SONRAI_API_CASSETTE_MODE: record or replay (default replay)
+# SONRAI_API_CASSETTE_MATCH: exact, or query to replay a request whose variables differ from the recording
+
+# Thread safety:
+# All state lives on the SonraiApi instance, so several clients (for example one per org) can be used side
+# by side.  One instance may be shared by a thread pool issuing concurrent executeQuery calls: token lookup
+# and renewal are serialized by a lock and requests share the instance's connection pool.  Errors are raised
+# as SonraiApiException (see exitCode for the status the command line scripts exit with).
+
+import atexit
 import logging
 import os
 import time
+import csv
+import gzip
+import hashlib
+import io
 import json
+import random
 import requests
 import jwt
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
 from os import path
+from requests.adapters import HTTPAdapter
+
+# advisory locking of the token store is only available on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class SonraiApiException(Exception):
+    """Base class for SonraiApi errors, exitCode is the status the scripts exit with"""
+    def __init__(self, message, exitCode=1):
+        super().__init__(message)
+        self.exitCode = exitCode
+
+
+class SonraiApiAuthException(SonraiApiException):
+    """No valid token was found or the server rejected it"""
+    pass
+
+
+class SonraiApiRequestException(SonraiApiException):
+    """The request still failed after all retries"""
+    pass
+
+
+class SonraiCassette:
+    """Records requests and responses to a gzip file, or answers requests from one without using the network.
+
+    One line per request: the request as JSON, a tab, then the response as JSON.  Requests are matched on the
+    query (whitespace collapsed) and the variables.  With match "query" a request whose variables differ is
+    answered from the same query's recordings (for variables holding the current time, never for paging).
+    A request recorded several times gets its responses in the recorded order, the last
+    one repeating.  Token renewals are never recorded.
+    """
+
+    # one cassette per file and process, shared by every SonraiApi instance
+    cassettes = {}
+    cassettesLock = threading.Lock()
+
+    @classmethod
+    def forFile(cls, filename, mode, match="exact"):
+        if mode not in ("record", "replay"):
+            raise SonraiApiException("SONRAI_API_CASSETTE_MODE must be record or replay, not " + str(mode))
+        if match not in ("exact", "query"):
+            raise SonraiApiException("SONRAI_API_CASSETTE_MATCH must be exact or query, not " + str(match))
+        with cls.cassettesLock:
+            key = (os.path.abspath(filename), mode, match)
+            if key not in cls.cassettes:
+                cls.cassettes[key] = cls(filename, mode, match)
+            return cls.cassettes[key]
+
+    def __init__(self, filename, mode, match="exact"):
+        self.filename = filename
+        self.recording = mode == "record"
+        self.replaying = mode == "replay"
+        self.matchQuery = match == "query"
+        self.lock = threading.Lock()
+        self.writer = None
+        self.recorded = None
+        self.logger = logging.getLogger("sonrai.py")
+
+    # requestKey - The query with its whitespace collapsed and the variables, as one canonical string.
+    def requestKey(self, query, variables):
+        if isinstance(variables, str):
+            variables = json.loads(variables or "{}")
+        return json.dumps([" ".join(query.split()), variables or {}], sort_keys=True)
+
+    def queryKey(self, query):
+        return " ".join(query.split())
+
+    # record - Append the request (the POST body) and its response to the cassette.
+    def record(self, postFields, queryName, status, body):
+        request = json.loads(postFields)
+        variables = request.get("variables")
+        if isinstance(variables, str):
+            variables = json.loads(variables or "{}")
+        line = json.dumps({"query_name": queryName, "query": request.get("query"), "variables": variables or {}, "status": status}) + "\t" + json.dumps(body) + "\n"
+        with self.lock:
+            if self.writer is None:
+                self.writer = gzip.open(self.filename, "at", encoding="utf-8")
+                atexit.register(self.close)
+                self.logger.info("recording responses to " + self.filename)
+            self.writer.write(line)
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+    # replay - Return the recorded (status, body) for the request (the POST body).
+    def replay(self, postFields):
+        request = json.loads(postFields)
+        with self.lock:
+            if self.recorded is None:
+                self.recorded = self.load()
+            exact, byQuery = self.recorded
+            entry = exact.get(self.requestKey(request.get("query") or "", request.get("variables")))
+            if entry is None and self.matchQuery:
+                entry = byQuery.get(self.queryKey(request.get("query") or ""))
+                if entry is not None:
+                    self.logger.debug("no recording with these variables, replaying the next response recorded for the query")
+            if entry is None:
+                raise SonraiApiRequestException("no recorded response in " + self.filename + " for this request and variables", 255)
+            status, body = entry[0][min(entry[1], len(entry[0]) - 1)]
+            entry[1] += 1
+        return status, json.loads(zlib.decompress(body))
+
+    # load - Read the cassette into two indexes, by query and variables and by query alone.  Responses are kept
+    # compressed until they are replayed.
+    def load(self):
+        exact = {}
+        byQuery = {}
+        try:
+            with gzip.open(self.filename, "rt", encoding="utf-8") as cassette:
+                for line in cassette:
+                    request, _, response = line.rstrip("\n").partition("\t")
+                    request = json.loads(request)
+                    recording = (request["status"], zlib.compress(response.encode("utf-8"), 1))
+                    exact.setdefault(self.requestKey(request["query"], request["variables"]), [[], 0])[0].append(recording)
+                    byQuery.setdefault(self.queryKey(request["query"]), [[], 0])[0].append(recording)
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            raise SonraiApiException("unable to read the cassette " + self.filename + ": " + str(e))
+        self.logger.info("replaying " + str(sum(len(entry[0]) for entry in exact.values())) + " recorded requests from " + self.filename)
+        return exact, byQuery
+
 
 class SonraiApi:
 
+    # stand-ins for the token's server and org while replaying a cassette without a token
+    REPLAY_SERVER = "cassette.replay"
+    REPLAY_ORG = "cassette"
+
     def __init__(self, queryName = "SonraiAPILibrary", savedQueryName = None, queryFileName = None, queryVariables = "{}", outputMode = "blob"):
-        global TOKENSTORE, TOKENFILE, TOKEN_DEFAULT_LENGTH, ENV_TOKEN, APISERVER, URL
 
         self.api_raw_response = None
         self.api_parsed_response = None
         self.outputMode = outputMode
 
-        APISERVER = os.environ.get("APISERVER",None)
-        ENV_TOKEN = os.environ.get("TOKEN",None)
-        TOKENSTORE = os.environ.get("SONRAI_API_TOKENSTORE","/tmp/sonrai")
-        TOKENFILE = os.environ.get("SONRAI_API_TOKENFILE","token")
+        self.apiserver = os.environ.get("APISERVER",None)
+        self.envToken = os.environ.get("TOKEN",None)
+        self.tokenstore = os.environ.get("SONRAI_API_TOKENSTORE","/tmp/sonrai")
+        self.tokenfile = os.environ.get("SONRAI_API_TOKENFILE","token")
+        self.URL = None
         TOKEN_DEFAULT_LENGTH_SEC = os.environ.get("TOKEN_DEFAULT_LENGTH_SEC",7200)
         self.token_default_length_sec = TOKEN_DEFAULT_LENGTH_SEC
         self.loglevel=os.environ.get("LOGLEVEL", "ERROR")
@@ -55,9 +206,31 @@ class SonraiApi:
         self.logger.info("logging level: " + self.loglevel)
         self.proxyserver = os.environ.get('PROXYSERVER', None)
         self.checkcertificate = True
+        self.session = None
+        self.sessionLock = threading.Lock()
+        self.poolsize = int(os.environ.get("POOLSIZE", 10))
+        self.keepalive = os.environ.get("KEEPALIVE", "1").lower() not in ("0", "false", "no")
+        self.retrymaxdelay = float(os.environ.get("RETRYMAXDELAYSEC", 60))
         self.audience="crc-graphql-server.sonraisecurity.com"
         self.jwtoptions = {"verify_iat":True, "verify_nbf":True, "verify_exp":True, "verify_iss":True, "verify_aud":True, "verify_signature":False}
 
+        # validated token and its claims, reused by executeQuery until the token nears its refresh threshold
+        self.decodedToken = None
+        self.currentToken = None
+        self.tokenRecheckTime = 0
+        self.tokenLock = threading.RLock()
+
+        # opt-in result cache for savedQueryName, refreshCache re-runs the search and replaces the cached result
+        self.savedQueryName = savedQueryName
+        self.cacheTTL = int(os.environ.get("SAVEDQUERYCACHETTL", 0))
+        self.cacheDir = os.environ.get("SAVEDQUERYCACHEDIR", os.path.join(self.tokenstore, "cache"))
+        self.refreshCache = False
+
+        # opt-in record / replay of every request, see SonraiCassette
+        self.cassette = None
+        if os.environ.get("SONRAI_API_CASSETTE"):
+            self.cassette = SonraiCassette.forFile(os.environ["SONRAI_API_CASSETTE"], os.environ.get("SONRAI_API_CASSETTE_MODE", "replay").lower(),
+                                                   os.environ.get("SONRAI_API_CASSETTE_MATCH", "exact").lower())
 
         # minimum refresh window is 1800 seconds (30m)
         token_refresh_threshold = int(os.environ.get("TOKENREFRESHTHRESHOLDSEC", 1800))
@@ -100,7 +273,7 @@ class SonraiApi:
             except Exception as e:
                 self.logger.error("Argument passed to as variable is not valid JSON.")
                 self.logger.error("Example of valid JSON on the command line would be: '{\"key\": \"value\"}'")
-                exit()
+                raise SonraiApiException("Argument passed as variable is not valid JSON")
 
     def verify(self, verify=True):
             self.checkcertificate = verify
@@ -109,22 +282,68 @@ class SonraiApi:
     # SonraiGraphQLQuery - Call the GraphQL API and return the response.
 
     def SonraiGraphQLQuery(self,varServer,varQuery,varQueryName,token):
+        # with a cassette, responses are recorded or replayed - token renewals always go to the server
+        cassette = self.cassette if varQueryName != "SonraiAPIClient_TokenRenew" else None
+        if cassette is not None and cassette.replaying:
+            status, body = cassette.replay(varQuery)
+        else:
+            status, body = self.postQuery(varServer, varQuery, varQueryName, token)
+            if cassette is not None and cassette.recording:
+                cassette.record(varQuery, varQueryName, status, body)
+
+        self.logger.debug("status code: " +  str(status) + " / server: " + str(varServer) )
+
+        if status in (404,403,402):
+            self.logger.error("*** AUTHENTICATION FAILED ***")
+            self.logger.error("" + str(status) + " error - please check your server setting: " + str(varServer) )
+            raise SonraiApiAuthException("*** AUTHENTICATION FAILED *** - " + str(status), 10)
+        if status == 401:
+            self.logger.error("*** API AUTHENTICATION FAILED ***")
+            self.logger.debug("Token used: "+str(token))
+            self.logger.error("API token expired, please get a new one from the Advanced Search UI.")
+            raise SonraiApiAuthException("API token expired", 9)
+        elif status == 500:
+            self.logger.error("Error returned " )
+            self.logger.error(str(body))
+            # adding sleep, to see if the graphql server can recover
+            if cassette is None or not cassette.replaying:
+                time.sleep(9)
+            # removing exit - should only abort on a non-recoverable error, like failed auth
+            # sys.exit(8)
+        elif "Unexpected exception while fetching Grpc data" in str(body):
+            self.logger.error("GPRC error message received:")
+            self.logger.error("This occurs if the query size limit is reached.")
+            self.logger.error("Try limiting your query with additional filters & try again.")
+            self.logger.error(json.dumps(body))
+            # removing exit - should only abort on a non-recoverable error, like failed auth
+            # sys.exit(7)
+
+
+        if not isinstance(body, dict):
+            self.logger.error("unexpected response: " + str(body)[:200])
+            raise SonraiApiRequestException("unexpected response from the server, status " + str(status), 255)
+        return body
+    ##  end SonraiGraphQLQuery
+
+    # postQuery - Send the request, retrying connection errors.  Returns the status code and the decoded body.
+    def postQuery(self,varServer,varQuery,varQueryName,token):
         varHeaders = self.buildAuthHeader(token, varQueryName)
         # varHeaders['Cache=Control'] = 'no-cache'
-        self.sonraiquery = requests.session()
+        self.sonraiquery = self.getSession()
 
         if self.checkcertificate is False:
             self.sonraiquery.verify = False
             self.logger.debug("ssl verification disabled")
 
         if self.proxyserver:
-            self.proxy = {
+            proxies = {
                 "http": self.proxyserver,
                 "https": self.proxyserver
             }
             self.logger.debug("using proxy server: " + self.proxyserver)
         else:
-            self.proxy = None
+            proxies = None
+        self.proxy = proxies
 
 
         # adding up to 10 retries
@@ -133,83 +352,71 @@ class SonraiApi:
 
         while retries < 10 and complete is False:
             try:
-                myResponse=self.sonraiquery.post(varServer, data=varQuery, headers=varHeaders, proxies=self.proxy, timeout=120)
-
-            except requests.exceptions.ConnectionError:
-                self.logger.error("*** CONNECTION ERROR to: " + varServer + " - retrying? ")
-                if self.loglevel == "DEBUG":
-                    print("r")
-                retries += 1
-                time.sleep(5)
+                myResponse=self.sonraiquery.post(varServer, data=varQuery, headers=varHeaders, proxies=proxies, timeout=120)
 
+            # SSLError and ProxyError are ConnectionErrors, so they have to be caught first
             except requests.exceptions.SSLError:
                 self.logger.error("*** SSL Certificate verification failed for: " + varServer + " - self signed detected? ")
                 if self.loglevel == "DEBUG":
                     print("r")
-                retries += 1
-                time.sleep(5)
 
             except requests.exceptions.ProxyError:
                 self.logger.error("*** Proxy Unreachable: " + str(self.proxyserver) )
                 if self.loglevel == "DEBUG":
                     print("r")
-                retries += 1
-                time.sleep(5)
+
+            except requests.exceptions.ConnectionError:
+                self.logger.error("*** CONNECTION ERROR to: " + varServer + " - retrying? ")
+                if self.loglevel == "DEBUG":
+                    print("r")
 
             except requests.exceptions.Timeout:
                 self.logger.error("*** Request timeout. Wait a few minutes & try your query again. If the error continues, contact sonrai support")
                 if self.loglevel == "DEBUG":
                     print("r")
-                retries += 1
-                time.sleep(5)
 
-            except requests.exceptions.RequestException:
+            except requests.exceptions.RequestException as e:
                 self.logger.error("*** Request error. Wait a few minutes & try your query again. If the error continues, contact sonrai support")
-                self.logger.error("*** Message: " + json.dumps(myResponse))
+                self.logger.error("*** Message: " + str(e))
                 if self.loglevel == "DEBUG":
                     print("r")
-                retries += 1
-                time.sleep(5)
 
             else:
                 complete=True
 
-            if retries == 10 and complete is False:
-                print("failed after {} retries, aborting".format(retries))
-                sys.exit(255)
-
-
-
-        self.logger.debug("status code: " +  str(myResponse.status_code) + " / server: " + varServer )
-
-        if myResponse.status_code in (404,403,402):
-            self.logger.error("*** AUTHENTICATION FAILED ***")
-            self.logger.error("" + str(myResponse.status_code) + " error - please check your server setting: " + varServer )
-            sys.exit(10)
-        if myResponse.status_code == 401:
-            self.logger.error("*** API AUTHENTICATION FAILED ***")
-            self.logger.debug("Token used: "+token)
-            self.logger.error("API token expired, please get a new one from the Advanced Search UI.")
-            sys.exit(9)
-        elif myResponse.status_code == 500:
-            self.logger.error("Error returned " )
-            self.logger.error(str(myResponse.json()))
-            # adding sleep, to see if the graphql server can recover
-            time.sleep(9)
-            # removing exit - should only abort on a non-recoverable error, like failed auth
-            # sys.exit(8)
-        elif "Unexpected exception while fetching Grpc data" in str(myResponse.json()):
-            self.logger.error("GPRC error message received:")
-            self.logger.error("This occurs if the query size limit is reached.")
-            self.logger.error("Try limiting your query with additional filters & try again.")
-            self.logger.error(json.dumps(myResponse.json()))
-            # removing exit - should only abort on a non-recoverable error, like failed auth
-            # sys.exit(7)
-
+            if complete is False:
+                retries += 1
+                if retries < 10:
+                    time.sleep(self.retryDelay(retries))
 
-        myResponse=myResponse.json()
-        return myResponse
-    ##  end SonraiGraphQLQuery
+            if retries == 10 and complete is False:
+                self.logger.error("failed after {} retries, aborting".format(retries))
+                raise SonraiApiRequestException("failed after {} retries, aborting".format(retries), 255)
+
+        try:
+            body = myResponse.json()
+        except ValueError:
+            body = myResponse.text
+        return myResponse.status_code, body
+
+
+    # getSession - One pooled session per instance, so connections are reused across queries.
+    def getSession(self):
+        with self.sessionLock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.poolsize, pool_maxsize=self.poolsize, max_retries=0)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                if not self.keepalive:
+                    session.headers["Connection"] = "close"
+                    self.logger.debug("http keep-alive disabled")
+                self.session = session
+        return self.session
+
+    # retryDelay - Exponential backoff with full jitter, capped at RETRYMAXDELAYSEC.
+    def retryDelay(self, retries):
+        return random.uniform(0, min(self.retrymaxdelay, 2 ** retries))
 
     # buildAuthHeader - Return the API authorization header.
 
@@ -221,21 +428,68 @@ class SonraiApi:
     #################### def ####################
     def storeToken(self, token):
 
-        self.logger.debug("storing token at " + os.path.join(TOKENSTORE,TOKENFILE))
-        if not (os.path.exists(TOKENSTORE)):
-            os.mkdir(TOKENSTORE)
-        with open(os.path.join(TOKENSTORE,TOKENFILE),"w") as tokendest:
-            tokendest.write(token)
-            tokendest.close()
+        self.logger.debug("storing token at " + os.path.join(self.tokenstore,self.tokenfile))
+        if not (os.path.exists(self.tokenstore)):
+            os.makedirs(self.tokenstore, mode=0o700, exist_ok=True)
+        # write to a temp file and rename it over the token, so other processes never read a partial token
+        fd, tmpname = tempfile.mkstemp(dir=self.tokenstore, prefix="." + self.tokenfile, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as tokendest:
+                tokendest.write(token)
+            os.replace(tmpname, os.path.join(self.tokenstore,self.tokenfile))
+        except OSError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
     ## end storeToken
 
+    # tokenStoreLock - Hold an exclusive lock on the token store while renewing, shared by every process using it.
+    def tokenStoreLock(self):
+        return self.fileLock(os.path.join(self.tokenstore,self.tokenfile) + ".lock")
+    ## end tokenStoreLock
+
+    # fileLock - Hold an exclusive advisory lock on lockname, shared by every process and thread using it.
+    @contextmanager
+    def fileLock(self, lockname):
+        if not (os.path.exists(os.path.dirname(lockname))):
+            os.makedirs(os.path.dirname(lockname), mode=0o700, exist_ok=True)
+        with open(lockname, "a+") as lockfile:
+            if fcntl is not None:
+                fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+    ## end fileLock
+
+    # renewedByOtherProcess - After waiting for the lock, return the stored token if another process already renewed it.
+    def renewedByOtherProcess(self, token):
+        try:
+            with open(os.path.join(self.tokenstore,self.tokenfile),"r") as tokensource:
+                storedToken = tokensource.read().strip()
+        except OSError:
+            return None
+
+        if storedToken and storedToken != token and self.tokenExpiry(storedToken) > self.tokenExpiry(token):
+            self.logger.debug("token was renewed by another process")
+            return storedToken
+        return None
+    ## end renewedByOtherProcess
+
+    def tokenExpiry(self, token):
+        try:
+            return jwt.decode(token, options={"verify_signature": False}).get('exp',0)
+        except jwt.exceptions.InvalidTokenError:
+            return 0
+
     # tokenExpiring - Check if token is near expiration and return true/false.
     def tokenExpiring(self, token):
 
         self.logger.debug("checking token expiration")
 
         # Decode token, parse expiration date, and calculate time remaining
-        token_expiry = jwt.decode(token, options=self.jwtoptions, algorithms=["RS256"], audience=self.audience ).get('exp',0)
+        token_expiry = self.decodeToken(token).get('exp',0)
         current_time = time.time()
         remaining = token_expiry - current_time
         self.logger.debug("expiry:"+str(token_expiry) + " || current: "+str(int(current_time)) + " || remaining: "+str(int(remaining))+"s")
@@ -244,8 +498,8 @@ class SonraiApi:
         if remaining < 0:
             self.logger.debug("token has expired, cannot be renewed - ("+str(int(remaining))+"s ago)")
             return True
-        elif remaining < 21600:
-            # if less than 6 hours remaining, attempt to renew
+        elif remaining < self.TOKEN_REFRESH_THRESHOLD_SEC:
+            # if less than TOKENREFRESHTHRESHOLDSEC remaining, attempt to renew
             self.logger.debug("token near expiration ("+str(int(remaining))+"s)... needs updating")
             return True
         else:
@@ -260,7 +514,7 @@ class SonraiApi:
         self.logger.debug("checking if token expired")
 
         # Decode token, parse expiration date, and calculate time remaining
-        token_expiry = jwt.decode(token, options=self.jwtoptions, algorithms=["RS256"], audience=self.audience ).get('exp',0)
+        token_expiry = self.decodeToken(token).get('exp',0)
         current_time = time.time()
         remaining = token_expiry - current_time
         # self.logger.debug("expiry:"+str(token_expiry) + " || current: "+str(int(current_time)) + " || remaining: "+str(int(remaining))+"s")
@@ -273,6 +527,14 @@ class SonraiApi:
 
     # renewToken - Call the renew token API and store it for future use.
     def renewLegacyToken(self, token):
+        # only one process renews, the others wait on the lock and reuse the token it stored
+        with self.tokenStoreLock():
+            storedToken = self.renewedByOtherProcess(token)
+            if storedToken:
+                return storedToken
+            return self._renewLegacyToken(token)
+
+    def _renewLegacyToken(self, token):
         # Call the renew token API
         self.logger.debug("calling renew token api")
 
@@ -292,7 +554,7 @@ class SonraiApi:
         POST_FIELDS = {"query": createapitokenquery, "variables": "{}"}
         POST_FIELDS = json.dumps(POST_FIELDS)
 
-        NewTokenJson=self.SonraiGraphQLQuery(URL,POST_FIELDS,QUERY_NAME,token)
+        NewTokenJson=self.SonraiGraphQLQuery(self.URL,POST_FIELDS,QUERY_NAME,token)
 
         newToken=NewTokenJson['data']['GenerateSonraiUserToken']['token']
         self.logger.info("retreived updated token")
@@ -307,6 +569,14 @@ class SonraiApi:
 
     # renewToken - Call the renew token API and store it for future use.
     def renewToken(self, token):
+        # only one process renews, the others wait on the lock and reuse the token it stored
+        with self.tokenStoreLock():
+            storedToken = self.renewedByOtherProcess(token)
+            if storedToken:
+                return storedToken
+            return self._renewToken(token)
+
+    def _renewToken(self, token):
         # Call the renew token API
         self.logger.debug("calling renew token api")
 
@@ -317,7 +587,7 @@ class SonraiApi:
         POST_FIELDS = {"query": CRC_COMMAND, "variables": "{}"}
         POST_FIELDS = json.dumps(POST_FIELDS)
 
-        NewTokenJson = self.SonraiGraphQLQuery(URL, POST_FIELDS, QUERY_NAME,
+        NewTokenJson = self.SonraiGraphQLQuery(self.URL, POST_FIELDS, QUERY_NAME,
                                                token)
 
         #newToken = NewTokenJson['data']['renewApiToken']['token']
@@ -341,17 +611,18 @@ class SonraiApi:
         else:
             # token_expiry = jwt.decode(token,verify=False).get('exp',0)
             self.getAudience(token)
-            token_expiry = jwt.decode(token, options=self.jwtoptions, algorithms=["RS256"], audience=self.audience ).get('exp',0)
+            token_expiry = self.decodeToken(token).get('exp',0)
             self.setGraphQLUrl(token)
             self.logger.debug("expires: " + str(token_expiry))
-            # try:
-            jwt.decode(token, options=self.jwtoptions, algorithms=["RS256"], audience=self.audience ).get('exp',0)
             if self.tokenExpiring(token) is False:
                 return True
             else:
                 if self.tokenExpired(token):
                     self.logger.debug("token already expired")
                     return False
+                elif self.cassette is not None and self.cassette.replaying:
+                    self.logger.debug("replaying a cassette, token not renewed")
+                    return True
                 else:
                     self.logger.debug("renewing existing token ")
                     self.renewToken(token)
@@ -366,9 +637,12 @@ class SonraiApi:
 
     def getGraphQLUrl(self, token):
 
-        if APISERVER is None:
+        if token is None:
+            # replaying a cassette without a token, the server is never contacted
+            s = self.apiserver or self.REPLAY_SERVER
+        elif self.apiserver is None:
             self.logger.debug("Pulling API server from token")
-            decoded_token = jwt.decode(token, options=self.jwtoptions, algorithms=["RS256"], audience=self.audience )
+            decoded_token = self.decodeToken(token)
             org = decoded_token['https://sonraisecurity.com/org']
             env = decoded_token['https://sonraisecurity.com/env']
             domain = ".sonraisecurity.com"
@@ -380,29 +654,42 @@ class SonraiApi:
             s = org + domain
         else:
             self.logger.debug("Pulling API server from env:APISERVER")
-            s = APISERVER
+            s = self.apiserver
 
-        URL = "https://"+s+"/graphql"
+        URL = self.graphQLUrl(s)
         self.logger.debug("API server: " + URL)
         return URL
 
+    # graphQLUrl - APISERVER may carry its own scheme, e.g. http://127.0.0.1:8080 for a local mock server.
+    def graphQLUrl(self, server):
+        if "://" in server:
+            return server.rstrip("/") + "/graphql"
+        return "https://"+server+"/graphql"
+
     def tokenOrg(self,token):
-        decoded_token = jwt.decode(token, options=self.jwtoptions, algorithms=["RS256"], audience=self.audience)
+        if token is None:
+            return self.REPLAY_ORG
+        decoded_token = self.decodeToken(token)
         org = decoded_token['https://sonraisecurity.com/org']
         return org
 
     def getAudience(self, token):
-        jwtoptions = {"verify_iat":True, "verify_nbf":True, "verify_exp":True, "verify_iss":True, "verify_aud":False, "verify_signature":False}
-        decoded_token = jwt.decode(token, options=jwtoptions, algorithms=["RS256"] )
-        self.audience = decoded_token['aud']
+        self.audience = self.decodeToken(token)['aud']
+
+    # decodeToken - Decode and validate a token once, later calls for the same token reuse the claims.
+    def decodeToken(self, token):
+        if self.decodedToken is None or self.decodedToken[0] != token:
+            # the audience is read from the token itself, so verifying it against itself adds nothing
+            jwtoptions = dict(self.jwtoptions, verify_aud=False)
+            self.decodedToken = (token, jwt.decode(token, options=jwtoptions, algorithms=["RS256"]))
+        return self.decodedToken[1]
 
     # setGraphQLUrl - Sets the GraphQL API URL to use, based on API token or APISERVER env var.
     def setGraphQLUrl(self, token):
-        global URL
 
-        if APISERVER is None:
+        if self.apiserver is None:
             self.logger.debug("Pulling API server from token")
-            decoded_token = jwt.decode(token, options=self.jwtoptions, algorithms=["RS256"], audience=self.audience )
+            decoded_token = self.decodeToken(token)
             org = decoded_token['https://sonraisecurity.com/org']
             env = decoded_token['https://sonraisecurity.com/env']
             domain = ".sonraisecurity.com"
@@ -414,24 +701,41 @@ class SonraiApi:
             s = org + domain
         else:
             self.logger.debug("Pulling API server from env:APISERVER")
-            s = APISERVER
+            s = self.apiserver
 
-        URL = "https://"+s+"/graphql"
-        self.logger.debug("API server: " + URL)
+        self.URL = self.graphQLUrl(s)
+        self.logger.debug("API server: " + self.URL)
 
     ## end getGraphQLUrl
 
-    # getToken - Check for env and file system tokens, renewing if necessary.  Returns token to use.
+    # getToken - Return the token to use.  The validated token is reused until it nears TOKENREFRESHTHRESHOLDSEC,
+    # only then are the env and file system tokens checked (and renewed if necessary) again.  A cassette replay
+    # needs no token, None is returned without looking one up.
     def getToken(self):
+        if self.cassette is not None and self.cassette.replaying:
+            return None
+        if self.currentToken is not None and time.time() < self.tokenRecheckTime:
+            return self.currentToken
+
+        # one thread looks the token up (and renews it), the others wait and reuse the result
+        with self.tokenLock:
+            if self.currentToken is None or time.time() >= self.tokenRecheckTime:
+                token = self.findToken()
+                self.tokenRecheckTime = self.decodeToken(token).get('exp',0) - self.TOKEN_REFRESH_THRESHOLD_SEC
+                self.currentToken = token
+            return self.currentToken
+
+    # findToken - Check for env and file system tokens, renewing if necessary.  Returns token to use.
+    def findToken(self):
 
         # Check for token in token store file.
         self.logger.debug("checking for filesystem token")
-        tokenCheck=path.exists(os.path.join(TOKENSTORE,TOKENFILE))
+        tokenCheck=path.exists(os.path.join(self.tokenstore,self.tokenfile))
 
         # check local token
         if tokenCheck is True:
-            self.logger.debug("filesystem token found: " + TOKENSTORE + "/" + TOKENFILE)
-            with open(os.path.join(TOKENSTORE,TOKENFILE),"r") as tokensource:
+            self.logger.debug("filesystem token found: " + self.tokenstore + "/" + self.tokenfile)
+            with open(os.path.join(self.tokenstore,self.tokenfile),"r") as tokensource:
                 token_fromfile = tokensource.read().strip()
                 tokensource.close()
 
@@ -443,7 +747,7 @@ class SonraiApi:
             else:
                 self.logger.debug("filesystem token invalid")
 
-        token_fromenv = ENV_TOKEN
+        token_fromenv = self.envToken
         self.logger.debug("checking env token")
 
         if self.validToken(token_fromenv):
@@ -457,7 +761,7 @@ class SonraiApi:
         else:
             self.logger.error("no valid tokens found in ENV or on disk.")
             self.logger.error("retrieve token from sonrai advanced search at: https://app.sonraisecurity.com/App/GraphExplorer")
-            sys.exit(253)
+            raise SonraiApiAuthException("no valid tokens found in ENV or on disk", 253)
 
 
 
@@ -473,28 +777,36 @@ class SonraiApi:
 
 
     def linebylineCSV (self, outputBlob):
+        # CSV text of the first 'items' list in the blob, header row first
+        items, count = self.findItems(outputBlob)
+        output = io.StringIO()
+        self.csvWriter(output, items or []).writerows(self.csvRow(item) for item in items or [])
+        return output.getvalue()
+
+    # csvWriter - DictWriter whose columns are the keys of the first item.
+    def csvWriter(self, stream, items):
+        fieldnames = list(items[0].keys()) if items else []
+        writer = csv.DictWriter(stream, fieldnames=fieldnames, restval="", extrasaction="ignore")
+        writer.writeheader()
+        return writer
+
+    # csvRow - Nested objects and lists are written as JSON in their cell.
+    def csvRow(self, item):
+        return {key: json.dumps(value) if isinstance(value, (dict, list)) else value for key, value in item.items()}
+
+    # findItems - Return the first 'items' list in a response blob and the count next to it (None when missing).
+    def findItems(self, outputBlob):
+        if not isinstance(outputBlob, dict):
+            return None, None
+        if isinstance(outputBlob.get("items"), list):
+            return outputBlob["items"], outputBlob.get("count")
         for key in outputBlob:
             if key == "count":
                 continue
-            elif key != "items":
-                results = self.linebylineCSV(outputBlob[key])
-            else:
-                csvRecords = ""
-                csvHeader = ""
-                count = 0
-                for item in outputBlob[key]:
-                    recordString = ""
-                    for recordKey in item:
-                        if count == 0:
-                            csvHeader += str(recordKey) + ", "
-                        recordString += str(item[recordKey]) + ", "
-                    csvRecords += recordString + "\n"
-                    count += 1
-
-                csv = csvHeader + "\n" + csvRecords
-                results = csv
-
-        return results
+            items, count = self.findItems(outputBlob[key])
+            if items is not None:
+                return items, count
+        return None, None
 
     def linebylineJSON (self, outputBlob):
         for key in outputBlob:
@@ -506,6 +818,49 @@ class SonraiApi:
                 results = (json.dumps(outputBlob, indent=4, sort_keys=True) + "\n")
         return results
 
+    # iteratePages - Yield the 'items' of a query one page at a time.  A query that declares $limit and $offset
+    # is paged automatically until the count (or a short page) is reached; any other query is a single page.
+    def iteratePages(self, query=None, variables=None, pageSize=1000):
+        if query is None:
+            query = self.CRC_COMMAND
+
+        if variables is None:
+            variables = self.queryVariables
+        if isinstance(variables, str):
+            variables = json.loads(variables or "{}")
+
+        paged = "$limit" in query and "$offset" in query
+        offset = 0
+        while True:
+            if paged:
+                variables = dict(variables, limit=pageSize, offset=offset)
+                self.logger.debug("querying " + str(pageSize) + " results, offset: " + str(offset))
+            response = self.rawQuery(query, variables)
+            items, count = self.findItems(response.get('data') or {})
+            if items is None:
+                if response.get('errors'):
+                    raise SonraiApiException("Query returned errors - " + str(response['errors'][0].get('message')))
+                return
+
+            yield items
+
+            offset += len(items)
+            if not paged or len(items) < pageSize or (count is not None and offset >= count):
+                return
+
+    def iterateItems(self, query=None, variables=None, pageSize=1000):
+        for page in self.iteratePages(query, variables, pageSize):
+            for item in page:
+                yield item
+
+    # rawQuery - Run a query and return the decoded response, whatever the outputMode.
+    def rawQuery(self, query, variables):
+        if self.cachesResult(query):
+            return self.cachedSavedQuery(query, variables)
+        POST_FIELDS = json.dumps({"query": query, "variables": variables})
+        CurrentToken = self.getToken()
+        return self.SonraiGraphQLQuery(self.URL,POST_FIELDS,self.QUERY_NAME,CurrentToken)
+
     def executeQuery(self, query=None, variables=None):
         if query is None:
             query = self.CRC_COMMAND
@@ -519,18 +874,77 @@ class SonraiApi:
         self.logger.debug("USING TOKEN: " + str(CurrentToken))
         queryName = self.QUERY_NAME
         self.logger.info("Using queryName of " + str(queryName))
-        cdc_response = self.SonraiGraphQLQuery(URL,POST_FIELDS,queryName,CurrentToken)
+        if self.cachesResult(query):
+            cdc_response = self.cachedSavedQuery(query, variables)
+        else:
+            cdc_response = self.SonraiGraphQLQuery(self.URL,POST_FIELDS,queryName,CurrentToken)
 
+        # build the result locally, api_parsed_response only keeps the last one for callers that read it
+        parsed_response = None
         #self.api_raw_response = cdc_response
         if self.outputMode == "blob":
             #self.api_parsed_response = json.dumps(cdc_response['data'], indent=4, sort_keys=True)
-            self.api_parsed_response = cdc_response
+            parsed_response = cdc_response
         elif self.outputMode == "lbl":
             # return just the first 'items' in the JSON
-            self.api_parsed_response = self.linebylineJSON(cdc_response['data'])
-        # elif self.outputMode == "csv":
-        # This second needs work
-        #     self.api_parsed_response = self.linebylineCSV(cdc_response['data'])
-        return self.api_parsed_response
+            parsed_response = self.linebylineJSON(cdc_response['data'])
+        elif self.outputMode == "csv":
+            parsed_response = self.linebylineCSV(cdc_response['data'])
+        self.api_parsed_response = parsed_response
+        return parsed_response
+
+    # cachesResult - Only the saved query runs through the result cache, and only when SAVEDQUERYCACHETTL is set.
+    def cachesResult(self, query):
+        return self.cacheTTL > 0 and self.savedQueryName is not None and query == self.CRC_COMMAND
+
+    # cachedSavedQuery - Run the saved query, reusing a result from the last SAVEDQUERYCACHETTL seconds when there is one.
+    # On a miss one process runs the search while the others using the same cache wait and then read its result.
+    def cachedSavedQuery(self, query, variables):
+        key = self.savedQueryCacheKey(variables)
+        if not self.refreshCache:
+            cached = self.readCachedResult(key)
+            if cached is not None:
+                return cached
+
+        with self.fileLock(os.path.join(self.cacheDir, key + ".lock")):
+            if not self.refreshCache:
+                cached = self.readCachedResult(key)
+                if cached is not None:
+                    return cached
+            POST_FIELDS = json.dumps({"query": query, "variables": variables})
+            response = self.SonraiGraphQLQuery(self.URL,POST_FIELDS,self.QUERY_NAME,self.getToken())
+            if isinstance(response, dict) and not response.get('errors'):
+                self.writeCachedResult(key, response)
+        return response
+
+    # savedQueryCacheKey - Cache entry name for the saved query, its override variables and the token's org.
+    def savedQueryCacheKey(self, variables):
+        if isinstance(variables, str):
+            variables = json.loads(variables or "{}")
+        keySource = json.dumps([self.savedQueryName, variables or {}, self.tokenOrg(self.getToken())], sort_keys=True)
+        return hashlib.sha256(keySource.encode("utf-8")).hexdigest()
+
+    def readCachedResult(self, key):
+        try:
+            with open(os.path.join(self.cacheDir, key + ".json"), "r") as cachesource:
+                entry = json.load(cachesource)
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires', 0) <= time.time():
+            return None
+        self.logger.info("Using cached result for saved query " + str(self.savedQueryName))
+        return entry.get('response')
+
+    def writeCachedResult(self, key, response):
+        # write to a temp file and rename it, so other processes never read a partial result
+        fd, tmpname = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as cachedest:
+                json.dump({"expires": time.time() + self.cacheTTL, "response": response}, cachedest)
+            os.replace(tmpname, os.path.join(self.cacheDir, key + ".json"))
+        except OSError as e:
+            self.logger.debug("unable to write the saved query cache: " + str(e))
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
 
     ################### end def ####################
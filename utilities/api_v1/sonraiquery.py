@@ -19,7 +19,8 @@ import sys, logging
 import os
 import json
 import getopt
-from sonrai import SonraiApi
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from sonrai import SonraiApi, SonraiApiException
 
 class SonraiQuery:
 
@@ -29,9 +30,14 @@ class SonraiQuery:
         self.queryName = "DefaultAPIQuery"
         self.queryVariables = "{}"
         self.outputMode="blob"
+        self.pageSize=1000
+        self.varsFile = None
+        self.parallel = 1
+        self.cacheTTL = None
+        self.refreshCache = False
 
         try:
-            opts, args = getopt.getopt(sys.argv[1:],'blhdq:f:n:v:', ["blob","linebyline", "help", "debug", "query=", "file=", "name=", "vars="])
+            opts, args = getopt.getopt(sys.argv[1:],'blcjhdq:f:n:v:', ["blob","linebyline", "csv", "ndjson", "page-size=", "vars-file=", "parallel=", "cache-ttl=", "refresh", "help", "debug", "query=", "file=", "name=", "vars="])
         except getopt.GetoptError as err:
             print(err)
             self.print_usage()
@@ -44,8 +50,20 @@ class SonraiQuery:
                 sys.exit()
             elif opt in ("-b", "--blob"):
                 self.outputMode = "blob"
-            # elif opt in ("-c", "--csv"):
-            #     self.outputMode = "csv"
+            elif opt in ("-c", "--csv"):
+                self.outputMode = "csv"
+            elif opt in ("-j", "--ndjson"):
+                self.outputMode = "ndjson"
+            elif opt == "--page-size":
+                self.pageSize = int(arg)
+            elif opt == "--vars-file":
+                self.varsFile = arg
+            elif opt == "--parallel":
+                self.parallel = max(1, int(arg))
+            elif opt == "--cache-ttl":
+                self.cacheTTL = int(arg)
+            elif opt == "--refresh":
+                self.refreshCache = True
             if opt in ("-l", "--linebyline"):
                 self.outputMode = "lbl"
             elif opt in ("-d", "--debug"):
@@ -82,7 +100,7 @@ class SonraiQuery:
     def print_usage(self):
         print("")
         print(" Usage:  ")
-        print("   ./sonraiquery.py [--debug] [--query NAME] [--file FILENAME] [--vars {VARS}]")
+        print("   ./sonraiquery.py [--debug] [--ndjson | --csv] [--query NAME] [--file FILENAME] [--vars {VARS}]")
         print("   ./sonraiquery.py --help")
         print("")
         print(" Options:")
@@ -90,21 +108,139 @@ class SonraiQuery:
         print("   -d, --debug                 Enable debugging.")
         print("   -b, --blob                  Print the output in raw format (DEFAULT)")
         print("   -l, --linebyline            Print each json data.items entry on it's own line.")
+        print("   -j, --ndjson                Stream the items as newline delimited JSON, one item per line.")
+        print("   -c, --csv                   Stream the items as CSV with a header row.")
+        print("   --page-size <n>             Items per page when streaming a query that declares $limit and $offset (DEFAULT 1000).")
         print("   -q <name>, --query <name>   Execute the saved query named <name>.")
         print("   -f <file>, --file <file>    Execute the query contained in <file>.")
         print("   -n <queryName>, --name <queryName>    Provide a query name of <queryName>.")
         print("   -v <vars>, --vars <vars>    Use the JSON string passed as <vars> as the GraphQL query variables.")
         print("                               Typically used with -f/--file when that GraphQL query requires variables.")
+        print("   --vars-file <file>          Run the query once per line of <file>, each line a JSON object of variables")
+        print("                               (merged over --vars). Every output line is tagged with its variables.")
+        print("   --parallel <n>              Number of --vars-file entries to run at the same time (DEFAULT 1).")
+        print("   --cache-ttl <secs>          Reuse a -q/--query result from the local cache for up to <secs> seconds.")
+        print("   --refresh                   Re-run the saved query and replace its cached result.")
         print("")
         print(" Environment variables:")
         print("   TOKEN                   Sonrai API auth token")
         print("   LOGLEVEL                ERROR, INFO, DEBUG - INFO is enabled by default")
+        print("   SAVEDQUERYCACHETTL      Default for --cache-ttl (0, the default, disables the cache)")
         print("")
 
 
+    # streamItems - Write the items to stdout as each page arrives, paging through $limit/$offset queries.
+    def streamItems(self):
+        writer = None
+        try:
+            for page in self.client.iteratePages(pageSize=self.pageSize):
+                if self.outputMode == "csv":
+                    if writer is None:
+                        writer = self.client.csvWriter(sys.stdout, page)
+                    writer.writerows(self.client.csvRow(item) for item in page)
+                else:
+                    for item in page:
+                        sys.stdout.write(json.dumps(item) + "\n")
+                sys.stdout.flush()
+        except BrokenPipeError:
+            self.readerGone()
+
+    # readerGone - The reader (head, jq ...) went away, stop quietly.
+    def readerGone(self):
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+    # readVarsFile - One JSON object of variables per line, merged over the -v/--vars variables.
+    def readVarsFile(self):
+        baseVars = json.loads(self.queryVariables)
+        varSets = []
+        with open(self.varsFile, "r") as varsSource:
+            for lineNumber, line in enumerate(varsSource, 1):
+                if not line.strip():
+                    continue
+                try:
+                    varSets.append(dict(baseVars, **json.loads(line)))
+                except (ValueError, TypeError):
+                    self.logger.error("Line " + str(lineNumber) + " of " + self.varsFile + " is not a JSON object.")
+                    sys.exit(2)
+        return varSets
+
+    # runVars - Execute the query for one set of variables, all pages when streaming items.
+    def runVars(self, varSet):
+        if self.outputMode in ("csv", "ndjson"):
+            return list(self.client.iterateItems(variables=varSet, pageSize=self.pageSize))
+        return self.client.executeQuery(variables=json.dumps(varSet))
+
+    # writeResult - Write the output of one variable set, every line tagged with its variables.
+    def writeResult(self, varSet, result):
+        if self.outputMode == "csv":
+            if not result:
+                return
+            # the header comes from the first set with rows; the vars column is renamed if the items have a vars field
+            if self.csvWriter is None:
+                self.csvVarsColumn = "vars"
+                while self.csvVarsColumn in result[0]:
+                    self.csvVarsColumn = "_" + self.csvVarsColumn
+                self.csvWriter = self.client.csvWriter(sys.stdout, [{self.csvVarsColumn: None, **result[0]}])
+            self.csvWriter.writerows({**self.client.csvRow(item), self.csvVarsColumn: json.dumps(varSet)} for item in result)
+        elif self.outputMode == "ndjson":
+            for item in result:
+                sys.stdout.write(json.dumps({"vars": varSet, "item": item}) + "\n")
+        else:
+            sys.stdout.write(json.dumps({"vars": varSet, "result": result}) + "\n")
+        sys.stdout.flush()
+
+    # sweepVars - Run the query once per --vars-file entry over one shared client, --parallel at a time.
+    # Results are written as they complete, so the output order can differ from the file.
+    def sweepVars(self):
+        varSets = iter(self.readVarsFile())
+        self.csvWriter = None
+        failures = 0
+        pending = {}
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as pool:
+            def submit():
+                for varSet in varSets:
+                    pending[pool.submit(self.runVars, varSet)] = varSet
+                    if len(pending) >= self.parallel * 2:
+                        break
+
+            submit()
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        varSet = pending.pop(future)
+                        try:
+                            self.writeResult(varSet, future.result())
+                        except SonraiApiException as e:
+                            failures += 1
+                            self.logger.error("query failed for variables " + json.dumps(varSet) + ": " + str(e))
+                            # the JSON outputs get an error line, a CSV stream only the log message on stderr
+                            if self.outputMode != "csv":
+                                sys.stdout.write(json.dumps({"vars": varSet, "error": str(e)}) + "\n")
+                    submit()
+            except BrokenPipeError:
+                for future in pending:
+                    future.cancel()
+                self.readerGone()
+
+        if failures:
+            self.logger.error(str(failures) + " of the variable sets failed")
+            sys.exit(1)
+
     def main (self):
         # setup an API client
         self.client = SonraiApi(self.queryName, self.savedQueryName, self.queryFileName, self.queryVariables, self.outputMode)
+        if self.cacheTTL is not None:
+            self.client.cacheTTL = self.cacheTTL
+        self.client.refreshCache = self.refreshCache
+        if self.varsFile:
+            self.sweepVars()
+            return
+        if self.outputMode in ("csv", "ndjson"):
+            self.streamItems()
+            return
         # execute the query passed in either the savedQueryNAme or the queryFileName
         results = self.client.executeQuery()
         # display results
@@ -121,4 +257,8 @@ def handle(myargv):
     HANDLER.main()
 
 if __name__ == "__main__":
-    handle(sys.argv[1:])
+    try:
+        handle(sys.argv[1:])
+    except SonraiApiException as e:
+        logging.error(str(e))
+        sys.exit(e.exitCode)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+# Runs the scripts end to end against the mock server (../mockserver) at several record scales and records the
+# wall time, requests, bytes transferred and peak RSS of every run.  The results are written as JSON and can be
+# compared with an earlier run (the baseline) to catch regressions.  See README.md in this folder.
+
+UTILITIES = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_SERVER = os.path.join(UTILITIES, "mockserver", "sonrai-mock-server.py")
+SCRIPTS = os.path.join(UTILITIES, "scripts")
+API_V1 = os.path.join(UTILITIES, "api_v1")
+
+DEFAULT_SCALES = "10000,100000,1000000"
+
+FINDINGS_QUERY = '''query exportFindings ($limit: Long, $offset: Long) {
+  ListFindings {
+    count
+    totalCount
+    pageCount
+    items (limit: $limit, offset: $offset) {
+      srn
+      title
+      status
+      severityCategory
+      resourceSrn
+      account
+      swimlanes
+      frameworkSrns
+      assignee
+      createdDate
+      lastModified
+    }
+  }
+}
+'''
+
+# Every scenario runs one script in a fresh working directory.  "{records}" and "{<file>}" in the arguments are
+# replaced with the record count of the run and the path of the generated input file.  "mock" sets the size of
+# the tenant, "max_records" caps scenarios that send one request per record (lifted with --uncapped).
+SCENARIOS = {
+    "search-export": {
+        "description": "Paged export of all findings to a JSON file",
+        "dir": SCRIPTS,
+        "script": "search-export.py",
+        "args": ["-q", "{query}", "-f", "export.json"],
+        "files": {"query": FINDINGS_QUERY},
+        "mock": ["--findings", "{records}"],
+    },
+    "bulk-ticket-export": {
+        "description": "bulk-ticket-operations.py --export with name lookups and one comment query per finding",
+        "dir": SCRIPTS,
+        "script": "bulk-ticket-operations.py",
+        "args": ["-f", "{query}", "-e", "export.json", "--name_lookup", "--list_comments"],
+        "files": {"query": FINDINGS_QUERY},
+        "mock": ["--findings", "{records}"],
+        "max_records": 10000,
+    },
+    "closetickets": {
+        "description": "Query open tickets in one request and close them in batches of 1000",
+        "dir": API_V1,
+        "script": "closetickets.py",
+        "args": ["--all-swimlanes", "-a", "-i", "-m", "{records}", "--maxclose-per-request", "1000"],
+        "mock": ["--tickets", "{records}"],
+        "max_records": 100000,
+    },
+    "bulk-service-action": {
+        "description": "One DisableService mutation per control key",
+        "dir": SCRIPTS,
+        "script": "bulk-service-action.py",
+        "args": ["-a", "disable", "-f", "{keys}", "-s", "aws/r-mock/ou-mock-1/100000000001"],
+        "files": {"keys": lambda records: "".join("service{}\n".format(_i) for _i in range(records))},
+        "mock": [],
+        "max_records": 10000,
+    },
+    "resource-report": {
+        "description": "sonrai-resource-report.py, all tickets against the resources of the enabled policies",
+        "dir": API_V1,
+        "script": "sonrai-resource-report.py",
+        "args": [],
+        "mock": ["--tickets", "{records}"],
+        "max_records": 100000,
+    },
+}
+
+# metrics compared against the baseline, with the difference below which a change is treated as noise
+METRICS = {
+    "wall_secs": 1.0,
+    "requests": 0,
+    "bytes_out": 0,
+    "bytes_in": 0,
+    "peak_rss_kb": 10240,
+}
+
+
+def parse_scales(value):
+    try:
+        _scales = [int(_s) for _s in value.split(",") if _s.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("--scales expects a comma separated list of record counts, got {}".format(value))
+    if not _scales or min(_scales) < 1:
+        raise argparse.ArgumentTypeError("--scales expects record counts of 1 or more, got {}".format(value))
+    return _scales
+
+
+def expand(values, substitutions):
+    return [_v.format(**substitutions) for _v in values]
+
+
+def write_run_config(run_dir):
+    # the scripts read sonrai_api/config.json from their working directory, point its stores into the run
+    # directory so runs do not share tokens, caches or remembered page sizes
+    with open(os.path.join(UTILITIES, "sonrai_api", "config.json")) as _file:
+        _config = json.load(_file)
+    _config.update({
+        "token_store": run_dir,
+        "authd_socket": os.path.join(run_dir, "authd.sock"),
+        "rate_limit_dir": os.path.join(run_dir, "ratelimit"),
+        "cache_dir": os.path.join(run_dir, "cache"),
+        "page_size_store": os.path.join(run_dir, "page_sizes.json"),
+    })
+    os.makedirs(os.path.join(run_dir, "sonrai_api"))
+    with open(os.path.join(run_dir, "sonrai_api", "config.json"), "w") as _file:
+        json.dump(_config, _file, indent=2)
+
+
+def start_mock(mock_args, log):
+    _process = subprocess.Popen([sys.executable, MOCK_SERVER, "--port", "0"] + mock_args,
+                                stdout=subprocess.PIPE, stderr=log, text=True)
+    _line = _process.stdout.readline()
+    _match = re.search(r"(http://\S+)/graphql", _line)
+    if _match is None:
+        _process.kill()
+        raise RuntimeError("mock server did not start: {}".format(_line.strip() or "no output, see the run log"))
+    return _process, _match.group(1)
+
+
+def stop_mock(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def read_stats(server):
+    with urllib.request.urlopen(server + "/stats", timeout=30) as _response:
+        return json.load(_response)
+
+
+def run_script(command, cwd, env, log, timeout):
+    # returns (exit code, wall seconds, peak RSS in KB) - os.wait4 gives the resource usage of this one child
+    _started = time.perf_counter()
+    _process = subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    _timer = threading.Timer(timeout, _process.kill)
+    _timer.start()
+    try:
+        _, _status, _usage = os.wait4(_process.pid, 0)
+    finally:
+        _timer.cancel()
+    _wall = time.perf_counter() - _started
+    _process.returncode = os.waitstatus_to_exitcode(_status)
+    return _process.returncode, _wall, _usage.ru_maxrss
+
+
+def run_scenario(name, scenario, scale, records, token, options, work_dir):
+    _run_dir = os.path.join(work_dir, "{}-{}".format(name, scale))
+    os.makedirs(_run_dir)
+    write_run_config(_run_dir)
+
+    _substitutions = {"records": records}
+    for _file, _content in scenario.get("files", {}).items():
+        _path = os.path.join(_run_dir, _file + ".txt")
+        with open(_path, "w") as _out:
+            _out.write(_content(records) if callable(_content) else _content)
+        _substitutions[_file] = _path
+
+    _env = dict(os.environ)
+    _env.update({"PYTHONUNBUFFERED": "1", "SONRAI_API_TOKENSTORE": _run_dir})
+    _command = [sys.executable, os.path.join(scenario["dir"], scenario["script"])] + expand(scenario["args"], _substitutions)
+
+    with open(os.path.join(_run_dir, "run.log"), "w") as _log:
+        _mock, _server = start_mock(expand(scenario["mock"], _substitutions) + options.mock_args, _log)
+        try:
+            _env.update({"TOKEN": token, "SONRAI_API_SERVER": _server, "APISERVER": _server})
+            _exit_code, _wall, _rss = run_script(_command, _run_dir, _env, _log, options.timeout)
+            _stats = read_stats(_server)
+        finally:
+            stop_mock(_mock)
+
+    return {
+        "scenario": name,
+        "scale": scale,
+        "records": records,
+        "exit_code": _exit_code,
+        "wall_secs": round(_wall, 3),
+        "requests": _stats["requests"],
+        "bytes_out": _stats["bytes_out"],
+        "bytes_in": _stats["bytes_in"],
+        "items": _stats["items"],
+        "peak_rss_kb": _rss,
+        "log": os.path.join(_run_dir, "run.log"),
+    }
+
+
+def run_key(run):
+    return "{}@{}".format(run["scenario"], run["scale"])
+
+
+def compare(results, baseline, tolerance):
+    # returns the regressions: metrics more than tolerance above the baseline (and above the noise floor)
+    _baseline = {run_key(_run): _run for _run in baseline.get("runs", [])}
+    _regressions = []
+    print("")
+    print("{:<30} {:<12} {:>14} {:>14} {:>9}".format("run", "metric", "baseline", "current", "change"))
+    for _run in results["runs"]:
+        _before = _baseline.get(run_key(_run))
+        if _before is None:
+            print("{:<30} not in the baseline".format(run_key(_run)))
+            continue
+        if _before.get("records") != _run["records"]:
+            print("{:<30} ran {} records, the baseline {} - not compared".format(run_key(_run), _run["records"], _before.get("records")))
+            continue
+        if _run["exit_code"] != 0:
+            _regressions.append("{} failed with exit code {}".format(run_key(_run), _run["exit_code"]))
+            continue
+        for _metric, _noise in METRICS.items():
+            _old, _new = _before.get(_metric), _run[_metric]
+            if _old is None:
+                continue
+            _change = (_new - _old) / _old if _old else 0.0
+            _flag = ""
+            if _new - _old > _noise and _new > _old * (1 + tolerance):
+                _flag = "  REGRESSION"
+                _regressions.append("{} {} {} -> {}".format(run_key(_run), _metric, _old, _new))
+            print("{:<30} {:<12} {:>14} {:>14} {:>+8.1%}{}".format(run_key(_run), _metric, _old, _new, _change, _flag))
+    return _regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run the scripts against the mock Sonrai API and record wall time, requests, bytes and peak RSS")
+    parser.add_argument("-s", "--scales", type=parse_scales, default=parse_scales(DEFAULT_SCALES),
+                        help="Comma separated record counts to run at. DEFAULT = " + DEFAULT_SCALES)
+    parser.add_argument("-S", "--scenario", action="append", choices=sorted(SCENARIOS), help="Run only this scenario (repeatable). DEFAULT = all")
+    parser.add_argument("-o", "--output", metavar="FILE", help="Write the results to <FILE> as JSON, e.g. to use as the baseline of later runs")
+    parser.add_argument("-b", "--baseline", metavar="FILE", help="Compare the results with the baseline <FILE>, exit with 1 on a regression")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.2, help="Allowed increase over the baseline as a fraction. DEFAULT = 0.2")
+    parser.add_argument("--uncapped", action="store_true", help="Run every scenario at the full scale, ignoring its record cap")
+    parser.add_argument("--timeout", type=float, default=3600, help="Seconds after which a run is killed. DEFAULT = 3600")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory (run logs and exported files)")
+    parser.add_argument("--list", action="store_true", help="List the scenarios and exit")
+    parser.add_argument("mock_args", nargs="*", metavar="-- MOCK OPTION",
+                        help="Options passed on to the mock server, e.g. -- --latency 0.05 --grpc-limit 5000")
+    options = parser.parse_args(argv)
+
+    if options.list:
+        for _name in SCENARIOS:
+            _cap = SCENARIOS[_name].get("max_records")
+            print("{:<22} {}{}".format(_name, SCENARIOS[_name]["description"], " (at most {} records)".format(_cap) if _cap else ""))
+        return 0
+
+    _baseline = None
+    if options.baseline:
+        try:
+            with open(options.baseline) as _file:
+                _baseline = json.load(_file)
+        except (OSError, ValueError) as e:
+            parser.error("unable to read the baseline {}: {}".format(options.baseline, e))
+
+    _token = subprocess.check_output([sys.executable, MOCK_SERVER, "--mint-token"], text=True).strip()
+    _work_dir = tempfile.mkdtemp(prefix="sonrai-benchmarks-")
+    _results = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mock_args": options.mock_args,
+        "runs": [],
+    }
+
+    print("{:<30} {:>9} {:>5} {:>10} {:>9} {:>13} {:>11}".format("run", "records", "exit", "wall secs", "requests", "bytes out", "peak RSS MB"))
+    try:
+        for _name in options.scenario or list(SCENARIOS):
+            _scenario = SCENARIOS[_name]
+            _ran = set()
+            for _scale in options.scales:
+                _records = _scale if options.uncapped else min(_scale, _scenario.get("max_records") or _scale)
+                if _records in _ran:
+                    # capped, the same run as at a smaller scale
+                    continue
+                _ran.add(_records)
+                _run = run_scenario(_name, _scenario, _scale, _records, _token, options, _work_dir)
+                _results["runs"].append(_run)
+                print("{:<30} {:>9} {:>5} {:>10.2f} {:>9} {:>13} {:>11.1f}".format(
+                    run_key(_run), _records, _run["exit_code"], _run["wall_secs"], _run["requests"], _run["bytes_out"], _run["peak_rss_kb"] / 1024), flush=True)
+                if _run["exit_code"] != 0:
+                    print("  failed, see {}".format(_run["log"]))
+    finally:
+        if options.keep:
+            print("Run logs and output kept in {}".format(_work_dir))
+        else:
+            shutil.rmtree(_work_dir, ignore_errors=True)
+
+    if not options.keep:
+        for _run in _results["runs"]:
+            _run.pop("log")
+    if options.output:
+        with open(options.output, "w") as _file:
+            json.dump(_results, _file, indent=2)
+        print("Results written to {}".format(options.output))
+
+    _failed = [_run for _run in _results["runs"] if _run["exit_code"] != 0]
+    if _baseline is not None:
+        _regressions = compare(_results, _baseline, options.tolerance)
+        if _regressions:
+            print("")
+            print("{} regression(s) over a {:.0%} tolerance:".format(len(_regressions), options.tolerance))
+            for _regression in _regressions:
+                print("  " + _regression)
+            return 1
+    return 1 if _failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
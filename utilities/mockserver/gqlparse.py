@@ -0,0 +1,177 @@
+import json
+import re
+
+# Just enough of a GraphQL parser for the mock server: the first operation of a document, its
+# selection set (aliases, arguments, nested selections and inline fragments) and argument values
+# with $variables substituted.  Named fragments, directives and type checking are not supported.
+
+_TOKEN_RE = re.compile(r'''
+    (?P<skip>[\s,]+|\#[^\n]*)
+  | (?P<block>"""(?:[^"\\]|\\.|"(?!""))*""")
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<name>[_A-Za-z][_0-9A-Za-z]*)
+  | (?P<spread>\.\.\.)
+  | (?P<punct>[{}()\[\]:$!=@])
+''', re.VERBOSE)
+
+
+class GraphQLSyntaxError(Exception):
+    """The document could not be parsed"""
+    pass
+
+
+class Field:
+    """One selected field: alias (the response key), name, arguments and child selections"""
+
+    def __init__(self, alias, name, args, selections):
+        self.alias = alias
+        self.name = name
+        self.args = args
+        self.selections = selections
+
+    def child(self, name):
+        # first child selection with this field name, or None
+        for _field in self.selections or []:
+            if _field.name == name:
+                return _field
+        return None
+
+
+def _tokenize(text):
+    _tokens = []
+    _pos = 0
+    while _pos < len(text):
+        _match = _TOKEN_RE.match(text, _pos)
+        if _match is None:
+            raise GraphQLSyntaxError("Unexpected character {!r} at {}".format(text[_pos], _pos))
+        _pos = _match.end()
+        _kind = _match.lastgroup
+        if _kind != "skip":
+            _tokens.append((_kind, _match.group(_kind)))
+    _tokens.append(("eof", None))
+    return _tokens
+
+
+class _Parser:
+
+    def __init__(self, text, variables):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+        self.variables = variables or {}
+
+    def peek(self, value=None):
+        _kind, _value = self.tokens[self.pos]
+        return _value == value if value is not None else _value
+
+    def take(self, value=None):
+        _kind, _value = self.tokens[self.pos]
+        if value is not None and _value != value:
+            raise GraphQLSyntaxError("Expected {!r} but found {!r}".format(value, _value))
+        if _kind == "eof":
+            raise GraphQLSyntaxError("Unexpected end of document")
+        self.pos += 1
+        return _kind, _value
+
+    def operation(self):
+        # returns (operation type, operation name, selections)
+        _type = "query"
+        _name = None
+        if self.peek() in ("query", "mutation", "subscription"):
+            _type = self.take()[1]
+            if self.tokens[self.pos][0] == "name":
+                _name = self.take()[1]
+            if self.peek("("):
+                self.skip_block("(", ")")
+            while self.peek("@"):
+                self.directive()
+        return _type, _name, self.selection_set()
+
+    def skip_block(self, opener, closer):
+        # variable definitions are not needed, the values come from the request
+        _depth = 0
+        while True:
+            _value = self.take()[1]
+            if _value == opener:
+                _depth += 1
+            elif _value == closer:
+                _depth -= 1
+                if _depth == 0:
+                    return
+
+    def directive(self):
+        self.take("@")
+        self.take()
+        if self.peek("("):
+            self.arguments()
+
+    def selection_set(self):
+        self.take("{")
+        _fields = []
+        while not self.peek("}"):
+            if self.peek("..."):
+                # inline fragment, its fields are merged into the parent selection
+                self.take("...")
+                if self.peek("on"):
+                    self.take("on")
+                    self.take()
+                _fields.extend(self.selection_set())
+                continue
+            _fields.append(self.field())
+        self.take("}")
+        return _fields
+
+    def field(self):
+        _alias = _name = self.take()[1]
+        if self.peek(":"):
+            self.take(":")
+            _name = self.take()[1]
+        _args = self.arguments() if self.peek("(") else {}
+        while self.peek("@"):
+            self.directive()
+        _selections = self.selection_set() if self.peek("{") else None
+        return Field(_alias, _name, _args, _selections)
+
+    def arguments(self):
+        self.take("(")
+        _args = {}
+        while not self.peek(")"):
+            _name = self.take()[1]
+            self.take(":")
+            _args[_name] = self.value()
+        self.take(")")
+        return _args
+
+    def value(self):
+        _kind, _value = self.take()
+        if _value == "$":
+            return self.variables.get(self.take()[1])
+        if _value == "[":
+            _list = []
+            while not self.peek("]"):
+                _list.append(self.value())
+            self.take("]")
+            return _list
+        if _value == "{":
+            _object = {}
+            while not self.peek("}"):
+                _key = self.take()[1]
+                self.take(":")
+                _object[_key] = self.value()
+            self.take("}")
+            return _object
+        if _kind == "number":
+            return float(_value) if any(_c in _value for _c in ".eE") else int(_value)
+        if _kind == "string":
+            # GraphQL string escapes are the same as JSON's
+            return json.loads(_value)
+        if _kind == "block":
+            return _value[3:-3]
+        if _kind == "name":
+            return {"true": True, "false": False, "null": None}.get(_value, _value)
+        raise GraphQLSyntaxError("Unexpected {!r} in an argument value".format(_value))
+
+
+def parse(text, variables=None):
+    # returns (operation type, operation name, [Field, ...]) for the first operation in the document
+    return _Parser(text, variables).operation()
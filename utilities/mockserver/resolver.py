@@ -0,0 +1,204 @@
+import base64
+import json
+import time
+
+import gqlparse
+
+# Answers GraphQL requests from a tenant.Tenant.  There is no schema: a query root field is treated as a
+# collection (count / totalCount / pageCount and items with limit / offset), a mutation root field as a
+# successful acknowledgement, and every other field gets a value chosen from its name.
+
+GRPC_LIMIT_MESSAGE = "Unexpected exception while fetching Grpc data"
+
+# collections up to this size can be filtered on any field, larger ones only by srn
+_SCAN_LIMIT = 100000
+
+
+class QueryError(Exception):
+    """Returned to the client in the GraphQL errors list"""
+    pass
+
+
+def mint_token(org, ttl=86400, env="prod"):
+    # an unsigned JWT with the claims the clients read; the scripts do not verify the signature
+    def _encode(part):
+        return base64.urlsafe_b64encode(json.dumps(part).encode("utf-8")).rstrip(b"=").decode("ascii")
+
+    _now = int(time.time())
+    _claims = {
+        "https://sonraisecurity.com/org": org,
+        "https://sonraisecurity.com/orgs": [org],
+        "https://sonraisecurity.com/env": env,
+        "iss": "https://sonraisecurity.com/",
+        "aud": "crc-graphql-server.sonraisecurity.com",
+        "sub": "mock-user",
+        "iat": _now,
+        "nbf": _now,
+        "exp": _now + int(ttl),
+    }
+    return "{}.{}.{}".format(_encode({"alg": "RS256", "typ": "JWT"}), _encode(_claims), _encode("mock-signature"))
+
+
+class MockGraph:
+    """Executes a request against the tenant, execute() returns (response, number of items returned)"""
+
+    def __init__(self, tenant, grpc_limit=0, default_limit=10000):
+        self.tenant = tenant
+        self.grpc_limit = grpc_limit
+        self.default_limit = default_limit
+
+    def execute(self, query, variables=None):
+        # requests are served by several threads, so each one gets its own _Execution
+        _execution = _Execution(self)
+        try:
+            _type, _name, _fields = gqlparse.parse(query or "", variables)
+            if _type == "mutation":
+                _data = {_f.alias: _execution.mutation(_f) for _f in _fields}
+            else:
+                _data = {_f.alias: _execution.query(_f) for _f in _fields}
+        except (gqlparse.GraphQLSyntaxError, QueryError) as e:
+            return {"data": None, "errors": [{"message": str(e)}]}, 0
+        return {"data": _data}, _execution.served
+
+
+class _Execution:
+
+    def __init__(self, graph):
+        self.tenant = graph.tenant
+        self.grpc_limit = graph.grpc_limit
+        self.default_limit = graph.default_limit
+        self.served = 0
+
+    # queries
+
+    def query(self, field):
+        if field.name == "ExecuteSavedQuery":
+            return self._saved_query(field)
+        return self._collection(field.name, field)
+
+    def _collection(self, name, field):
+        _items_field = field.child("items")
+        _args = dict(field.args)
+        if _items_field is not None:
+            # limit / offset may be given on the root field or on items
+            _args.update(_items_field.args)
+
+        _indices = self._select(name, field.args.get("where"))
+        _offset = int(_args.get("offset") or 0)
+        _limit = _args.get("limit")
+        _limit = self.default_limit if _limit is None else int(_limit)
+        _page = _indices[_offset:_offset + _limit]
+        # like the real server, the limit applies to the rows fetched, a small lookup without a limit is fine
+        if self.grpc_limit and len(_page) > self.grpc_limit and _items_field is not None:
+            raise QueryError(GRPC_LIMIT_MESSAGE)
+
+        _result = {}
+        for _child in field.selections or []:
+            if _child.name == "items":
+                _result[_child.alias] = [self._record(name, _i, _child.selections) for _i in _page]
+                self.served += len(_page)
+            elif _child.name in ("count", "totalCount"):
+                _result[_child.alias] = len(_indices)
+            elif _child.name == "pageCount":
+                _result[_child.alias] = len(_page)
+            elif _child.selections is None:
+                _result[_child.alias] = self.tenant.value(name, 0, _child.name)
+            else:
+                _result[_child.alias] = self._record(_child.name, 0, _child.selections)
+        return _result
+
+    def _select(self, name, where):
+        # indices of the records matching the EQ / IN_LIST conditions in where, other conditions are ignored
+        _count = self.tenant.count(name)
+        _indices = range(_count)
+        if not isinstance(where, dict):
+            return _indices
+
+        for _key, _condition in where.items():
+            if not isinstance(_condition, dict) or _condition.get("op", "EQ") not in ("EQ", "IN_LIST"):
+                continue
+            if "value" not in _condition and "values" not in _condition:
+                # a condition on a related object, e.g. containedByControlFramework: {items: {...}}
+                continue
+            _values = _condition["values"] if "values" in _condition else [_condition.get("value")]
+            if _key == "srn":
+                _wanted = {self.tenant.srn_index(name, _v) for _v in _values}
+                _indices = [_i for _i in sorted(_i for _i in _wanted if _i is not None) if _i in _indices]
+            elif _count <= _SCAN_LIMIT:
+                _indices = [_i for _i in _indices if self._matches(self.tenant.value(name, _i, _key), _values)]
+        return _indices
+
+    @staticmethod
+    def _matches(value, values):
+        if isinstance(value, list):
+            return any(_v in values for _v in value)
+        return value in values
+
+    def _record(self, collection, index, selections):
+        _record = {}
+        for _field in selections or []:
+            if _field.selections is None:
+                _record[_field.alias] = self.tenant.value(collection, index, _field.name)
+            elif _field.name in ("items", "results"):
+                _record[_field.alias] = [self._record(_field.name, index * 2 + _n, _field.selections) for _n in range(2)]
+            else:
+                # nested object, e.g. policy { title } - its own record, picked from the parent
+                _record[_field.alias] = self._record(_field.name, self.tenant.hash(collection, index, _field.name) % 1000, _field.selections)
+        return _record
+
+    def _saved_query(self, field):
+        # the Query field is a JSON scalar holding the saved search result, here the newest tickets
+        _tickets = {
+            "count": self.tenant.count("Tickets"),
+            "items": [self._flat_record("Tickets", _i) for _i in range(min(100, self.tenant.count("Tickets")))]
+        }
+        self.served += len(_tickets["items"])
+        return {_child.alias: {"Tickets": _tickets} for _child in field.selections or []}
+
+    def _flat_record(self, collection, index):
+        return {_name: self.tenant.value(collection, index, _name) for _name in ("srn", "title", "status", "severityCategory", "createdDate")}
+
+    # mutations
+
+    def mutation(self, field):
+        if field.name == "GenerateSonraiUserToken":
+            _ttl = int((field.args.get("input") or {}).get("expiresIn") or 86400)
+            _values = {"token": mint_token(self.tenant.org, _ttl), "expireAt": int(time.time()) + _ttl}
+            return {_child.alias: _values.get(_child.name) for _child in field.selections or []}
+        return self._acknowledge(field.name, field.selections, self._input_size(field.args))
+
+    def _input_size(self, value):
+        # number of things the mutation was asked to change: the length of the first list in its arguments
+        if isinstance(value, list):
+            return len(value)
+        if isinstance(value, dict):
+            for _v in value.values():
+                _size = self._input_size(_v)
+                if _size is not None:
+                    return _size
+        return None
+
+    def _acknowledge(self, name, selections, size):
+        _size = 1 if size is None else size
+        _result = {}
+        for _field in selections or []:
+            if _field.selections is not None:
+                if _field.name == "items":
+                    _result[_field.alias] = []
+                elif _field.name == "results":
+                    _result[_field.alias] = [self._acknowledge(name, _field.selections, None) for _ in range(_size)]
+                else:
+                    _result[_field.alias] = self._acknowledge(name, _field.selections, size)
+            elif _field.name in ("success",):
+                _result[_field.alias] = True
+            elif _field.name in ("error", "errors", "message"):
+                _result[_field.alias] = None
+            elif _field.name == "ackMessage":
+                _result[_field.alias] = "Request accepted"
+            elif _field.name in ("taskSize", "successCount", "count"):
+                _result[_field.alias] = _size
+            elif _field.name in ("failureCount", "totalCount"):
+                _result[_field.alias] = 0
+            else:
+                _result[_field.alias] = self.tenant.value(name, 0, _field.name)
+        return _result
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import resolver
+import tenant
+
+# Local stand-in for the Sonrai GraphQL API, for load tests, benchmarks and profiling without a real tenant.
+# See README.md in this folder.
+
+logger = logging.getLogger("sonrai-mock-server")
+
+
+class Stats:
+    """Request, byte and item counters, served as JSON on GET /stats"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters = {"requests": 0, "bytes_in": 0, "bytes_out": 0, "items": 0, "injected_errors": 0, "by_query_name": {}}
+
+    def record(self, query_name, bytes_in, bytes_out, items, injected=False):
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["bytes_in"] += bytes_in
+            self._counters["bytes_out"] += bytes_out
+            self._counters["items"] += items
+            self._counters["injected_errors"] += 1 if injected else 0
+            _by_name = self._counters["by_query_name"].setdefault(query_name, {"requests": 0, "bytes_out": 0})
+            _by_name["requests"] += 1
+            _by_name["bytes_out"] += bytes_out
+
+    def snapshot(self):
+        with self._lock:
+            return json.loads(json.dumps(self._counters))
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, graph, options):
+        super().__init__(address, MockHandler)
+        self.graph = graph
+        self.options = options
+        self.stats = Stats()
+        # failure injection is random but repeatable for a given --seed
+        self.random = random.Random(options.seed)
+        self.random_lock = threading.Lock()
+
+    def roll(self, rate):
+        if rate <= 0:
+            return False
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def choice(self, values):
+        with self.random_lock:
+            return self.random.choice(values)
+
+    def jitter(self):
+        with self.random_lock:
+            return self.random.uniform(0, self.options.jitter) if self.options.jitter > 0 else 0
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, without TCP_NODELAY every keep-alive response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, body, headers=None):
+        _data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(_data)))
+        for _name, _value in (headers or {}).items():
+            self.send_header(_name, _value)
+        self.end_headers()
+        self.wfile.write(_data)
+        return len(_data)
+
+    def do_GET(self):
+        _url = urlparse(self.path)
+        if _url.path != "/stats":
+            self.send_json(404, {"errors": [{"message": "Not found"}]})
+            return
+        self.send_json(200, self.server.stats.snapshot())
+        if "reset" in parse_qs(_url.query):
+            self.server.stats.reset()
+
+    def do_POST(self):
+        _options = self.server.options
+        _started = time.time()
+        _body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        _query_name = self.headers.get("query-name") or "unnamed"
+
+        if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+            _sent = self.send_json(401, {"errors": [{"message": "Unauthorized"}]})
+            self.server.stats.record(_query_name, len(_body), _sent, 0)
+            return
+
+        if self.server.roll(_options.throttle_rate):
+            _sent = self.send_json(429, {"errors": [{"message": "Too Many Requests"}]}, {"Retry-After": "1"})
+            self.server.stats.record(_query_name, len(_body), _sent, 0, injected=True)
+            return
+        if self.server.roll(_options.error_rate):
+            _status = self.server.choice((500, 502, 503))
+            _sent = self.send_json(_status, {"errors": [{"message": "Injected server error"}]})
+            self.server.stats.record(_query_name, len(_body), _sent, 0, injected=True)
+            return
+
+        try:
+            _request = json.loads(_body)
+            _variables = _request.get("variables") or {}
+            if isinstance(_variables, str):
+                # the api_v1 client sends the variables as a JSON string
+                _variables = json.loads(_variables or "{}")
+            _response, _items = self.server.graph.execute(_request.get("query"), _variables)
+        except (ValueError, AttributeError) as e:
+            _response, _items = {"data": None, "errors": [{"message": "Invalid request - {}".format(e)}]}, 0
+
+        # latency grows with the page, like the real service
+        _delay = _options.latency + _options.latency_per_item * _items + self.server.jitter()
+        _remaining = _delay - (time.time() - _started)
+        if _remaining > 0:
+            time.sleep(_remaining)
+
+        _sent = self.send_json(200, _response)
+        self.server.stats.record(_query_name, len(_body), _sent, _items)
+        logger.info("{} {} items, {} bytes in {:.3f}s".format(_query_name, _items, _sent, time.time() - _started))
+
+
+def parse_counts(values):
+    _counts = {}
+    for _value in values or []:
+        _name, _, _count = _value.partition("=")
+        if not _count.isdigit():
+            raise argparse.ArgumentTypeError("--count expects COLLECTION=N, got {}".format(_value))
+        _counts[_name] = int(_count)
+    return _counts
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Local stand-in for the Sonrai GraphQL API with a synthetic tenant")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on. DEFAULT = 8080")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on. DEFAULT = 127.0.0.1")
+    parser.add_argument("--org", default="mockorg", help="Org of the tenant and of minted tokens. DEFAULT = mockorg")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated data and the injected failures. DEFAULT = 1")
+    parser.add_argument("--findings", type=int, default=10000, help="Number of findings (ListFindings). DEFAULT = 10000")
+    parser.add_argument("--tickets", type=int, default=None, help="Number of tickets (Tickets). DEFAULT = same as --findings")
+    parser.add_argument("--count", action="append", metavar="COLLECTION=N", help="Size of any other collection, e.g. --count Swimlanes=500 (repeatable)")
+    parser.add_argument("--default-count", type=int, default=50, help="Size of the collections not set otherwise. DEFAULT = 50")
+    parser.add_argument("--accounts", type=int, default=100, help="Number of distinct cloud accounts in the data. DEFAULT = 100")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response. DEFAULT = 0")
+    parser.add_argument("--latency-per-item", type=float, default=0.0, help="Seconds added per item returned. DEFAULT = 0")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many random seconds added to every response. DEFAULT = 0")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 500/502/503. DEFAULT = 0")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 429. DEFAULT = 0")
+    parser.add_argument("--grpc-limit", type=int, default=0, help="Answer pages larger than this with the GRPC query limit error. DEFAULT = 0 (off)")
+    parser.add_argument("--mint-token", action="store_true", help="Print a token for this tenant (for TOKEN) and exit")
+    parser.add_argument("--token-ttl", type=int, default=86400, help="Lifetime of a minted token in seconds. DEFAULT = 86400")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log every request")
+    options = parser.parse_args(argv)
+
+    if options.mint_token:
+        print(resolver.mint_token(options.org, options.token_ttl))
+        return 0
+
+    logging.basicConfig(format='[%(asctime)s] [%(levelname)s] -- %(message)s', datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stderr)
+    logger.setLevel(logging.INFO if options.verbose else logging.WARNING)
+
+    try:
+        _counts = parse_counts(options.count)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    _counts.setdefault("ListFindings", options.findings)
+    _counts.setdefault("Tickets", options.findings if options.tickets is None else options.tickets)
+
+    _tenant = tenant.Tenant(options.org, options.seed, _counts, options.default_count, options.accounts)
+    _server = MockServer((options.host, options.port), resolver.MockGraph(_tenant, options.grpc_limit), options)
+    # stop cleanly when a benchmark or service manager sends SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Mock Sonrai API for org {} listening on http://{}:{}/graphql".format(options.org, options.host, _server.server_address[1]), flush=True)
+    try:
+        _server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
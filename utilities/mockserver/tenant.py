@@ -0,0 +1,159 @@
+import functools
+import time
+
+# Synthetic Sonrai tenant for the mock server.  Nothing is stored: record i of a collection is computed from
+# (seed, collection, i) whenever it is asked for, so a tenant with millions of findings costs no memory and
+# every run (and every page of a run) sees exactly the same data.  Field values are chosen from the field
+# name, which keeps the generator independent of the schema: any field a script selects gets a plausible value.
+
+# collection (root field) -> resource type used in its srns
+TYPES = {
+    "ListFindings": "Finding",
+    "Tickets": "Ticket",
+    "Swimlanes": "Swimlane",
+    "ControlFrameworks": "ControlFramework",
+    "ControlPolicies": "ControlPolicy",
+    "SonraiUsers": "SonraiUser",
+    "CloudHierarchyList": "CloudHierarchy",
+    "CloudServices": "CloudService",
+    "CloudControls": "CloudControl",
+    "ScopeOwners": "ScopeOwner",
+    "Tags": "Tag",
+    "Users": "User",
+    "Roles": "Role",
+    "Groups": "Group",
+    "PlatformAccounts": "PlatformAccount",
+    "ListCommentsForFinding": "FindingComment",
+}
+
+# fields holding srns that point into another collection, so lookups by srn find a record
+REFERENCES = {
+    "frameworkSrns": "ControlFrameworks",
+    "controlFrameworkSrn": "ControlFrameworks",
+    "swimlaneSrns": "Swimlanes",
+    "policySrn": "ControlPolicies",
+    "assignee": "SonraiUsers",
+    "createdBy": "SonraiUsers",
+    "userSrn": "SonraiUsers",
+    "swimlanes": "Swimlanes",
+    "resourceSwimlanes": "Swimlanes",
+    "operationalizedSwimlanes": "Swimlanes",
+}
+
+# base cards of the saved searches behind control policies (the "query" field)
+SEARCH_TYPES = ("Accounts", "Users", "Roles", "DataStores", "Buckets", "Functions")
+
+STATUSES = ("NEW", "NEW", "NEW", "CLOSED", "RISK_ACCEPTED", "SNOOZED")
+SEVERITIES = ("CRITICAL", "HIGH", "MEDIUM", "MEDIUM", "LOW", "LOW", "INFO")
+CLOUD_TYPES = ("aws", "aws", "aws", "azure", "gcp")
+_EPOCH = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, -1))
+_MASK = (1 << 64) - 1
+
+
+def _mix(value):
+    # splitmix64 finalizer - cheap, well spread and stable across runs and python versions
+    value = (value + 0x9E3779B97F4A7C15) & _MASK
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK
+    return value ^ (value >> 31)
+
+
+def _name_hash(name):
+    _h = 0
+    for _c in name:
+        _h = _mix(_h ^ ord(_c))
+    return _h
+
+
+class Tenant:
+    """Deterministic synthetic tenant, record i of any collection is generated on demand"""
+
+    def __init__(self, org="mockorg", seed=1, counts=None, default_count=50, accounts=100):
+        self.org = org
+        self.seed = seed
+        self.counts = dict(counts or {})
+        self.default_count = default_count
+        self.accounts = max(1, accounts)
+
+    def count(self, collection):
+        return self.counts.get(collection, self.default_count)
+
+    def hash(self, collection, index, salt=""):
+        return _mix(self.seed ^ _name_hash(collection + salt) ^ _mix(index))
+
+    def srn(self, collection, index):
+        # the index is kept in the last uuid group, so srn_index() can find the record again
+        _type = TYPES.get(collection, collection.rstrip("s") or "Resource")
+        return "srn:{}::{}/{:08x}-0000-4000-8000-{:012x}".format(self.org, _type, self.hash(collection, 0) & 0xFFFFFFFF, index)
+
+    def srn_index(self, collection, srn):
+        # record index for an srn generated by srn(), None for anything else
+        if not isinstance(srn, str) or srn != self.srn(collection, self._tail(srn)):
+            return None
+        return self._tail(srn)
+
+    @staticmethod
+    def _tail(srn):
+        try:
+            return int(srn.rsplit("-", 1)[-1], 16)
+        except ValueError:
+            return -1
+
+    def account(self, collection, index):
+        return "{:012d}".format(100000000000 + self.hash(collection, index, "account") % self.accounts)
+
+    def value(self, collection, index, name):
+        # scalar value of field name for record index of collection
+        return _resolver(name)(self, collection, index)
+
+
+def _timestamp(tenant, collection, index, name):
+    _seconds = _EPOCH + tenant.hash(collection, index, name) % (365 * 86400)
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(_seconds))
+
+
+@functools.lru_cache(maxsize=None)
+def _resolver(name):
+    # pick the generator for a field name once, records are then built with a dict lookup per field
+    _lower = name.lower()
+    if name == "srn":
+        return lambda t, c, i: t.srn(c, i)
+    if name in REFERENCES:
+        _target = REFERENCES[name]
+        if name.endswith(("Srns", "wimlanes")):
+            return lambda t, c, i: [t.srn(_target, t.hash(c, i, name) % max(1, t.count(_target)))]
+        return lambda t, c, i: t.srn(_target, t.hash(c, i, name) % max(1, t.count(_target)))
+    if name in ("resourceSrn", "ticketSrn", "findingSrn"):
+        return lambda t, c, i: t.srn({"resourceSrn": "Resources", "ticketSrn": "Tickets", "findingSrn": "ListFindings"}[name], i)
+    if _lower.endswith("srns"):
+        return lambda t, c, i: [t.srn(name[:-4], t.hash(c, i, name) % 1000)]
+    if _lower.endswith("srn"):
+        return lambda t, c, i: t.srn(name[:-3], t.hash(c, i, name) % 1000)
+    if name == "query":
+        # saved search definition (a JSON scalar), its root card is the resource type searched
+        return lambda t, c, i: {"fields": {"root": {"id": "root", "definition": {"name": SEARCH_TYPES[t.hash(c, i, name) % len(SEARCH_TYPES)]}}}}
+    if name == "email":
+        return lambda t, c, i: "user{}@{}.example.com".format(i, t.org)
+    if name == "status":
+        return lambda t, c, i: STATUSES[t.hash(c, i, name) % len(STATUSES)]
+    if name == "severityCategory":
+        return lambda t, c, i: SEVERITIES[t.hash(c, i, name) % len(SEVERITIES)]
+    if name == "cloudType":
+        return lambda t, c, i: CLOUD_TYPES[t.hash(c, i, name) % len(CLOUD_TYPES)]
+    if name in ("account", "resourceId", "accountId"):
+        return lambda t, c, i: t.account(c, i)
+    if name == "entryType":
+        return lambda t, c, i: "managementAccount" if i == 0 else "account"
+    if name == "scope":
+        return lambda t, c, i: "aws/r-mock/ou-mock-{}/{}".format(t.hash(c, i, "ou") % 20, t.account(c, i))
+    if name in ("name", "title", "friendlyName", "scopeFriendlyName", "resourceName", "label"):
+        return lambda t, c, i: "{} {} {}".format(TYPES.get(c, c), name, i)
+    if name.endswith(("Date", "Time", "At")) or name in ("date", "lastModified", "lastSeen", "firstSeen"):
+        return lambda t, c, i: _timestamp(t, c, i, name)
+    if (name[:2] == "is" and name[2:3].isupper()) or (name[:3] == "has" and name[3:4].isupper()) or name in ("active", "enabled", "success"):
+        return lambda t, c, i: t.hash(c, i, name) % 4 != 0
+    if name.endswith(("Count", "Numeric", "Level", "Size", "Score")) or name in ("count", "total", "number", "size"):
+        return lambda t, c, i: t.hash(c, i, name) % 100
+    if name == "__typename":
+        return lambda t, c, i: TYPES.get(c, c)
+    return lambda t, c, i: "{}-{}".format(name, i)
@@ -204,17 +204,41 @@ def resolve_scope(value, org_root=None):
     sys.exit(1)
 
 
-def run_action(action, control_key, scope, apply_at_scope, dryrun):
-    config = ACTIONS[action]
-    mutation = config["mutation"]
-    result_key = config["result_key"]
-    uses_apply_at_scope = config["uses_apply_at_scope"]
-
+def build_variables(action, control_key, scope, apply_at_scope):
     input_vars = {"controlKey": control_key, "scope": scope}
-    if uses_apply_at_scope:
+    if ACTIONS[action]["uses_apply_at_scope"]:
         input_vars["applyAtScope"] = apply_at_scope
 
-    variables = json.dumps({"input": input_vars})
+    return json.dumps({"input": input_vars})
+
+
+def handle_response(action, control_key, scope, response):
+    result_key = ACTIONS[action]["result_key"]
+
+    if response is None:
+        raise ValueError("API returned no response (None) — scope may be invalid or unrecognized")
+    result = response.get("data", {}).get(result_key) or {}
+    success = result.get("success", False)
+    issues = result.get("issues", {})
+    failure_count = issues.get("failureCount", 0) if issues else 0
+
+    if success:
+        logger.info(f"[{action}] '{control_key}' at scope '{scope}' — OK")
+    else:
+        logger.warning(f"[{action}] '{control_key}' at scope '{scope}' — success=False")
+
+    if failure_count:
+        logger.warning(f"  {failure_count} issue(s) reported:")
+        for item in issues.get("items", []):
+            logger.warning(f"    [{item.get('account')}] {item.get('message')} (scope: {item.get('scope')})")
+
+    return success
+
+
+def run_action(action, control_key, scope, apply_at_scope, dryrun):
+    mutation = ACTIONS[action]["mutation"]
+    uses_apply_at_scope = ACTIONS[action]["uses_apply_at_scope"]
+    variables = build_variables(action, control_key, scope, apply_at_scope)
 
     if dryrun:
         logger.info(f"[DRY RUN] Would {action} '{control_key}' at scope '{scope}'"
@@ -223,29 +247,32 @@ def run_action(action, control_key, scope, apply_at_scope, dryrun):
 
     try:
         response = api.execute_query(mutation, variables)
-        if response is None:
-            raise ValueError("API returned no response (None) — scope may be invalid or unrecognized")
-        result = response.get("data", {}).get(result_key) or {}
-        success = result.get("success", False)
-        issues = result.get("issues", {})
-        failure_count = issues.get("failureCount", 0) if issues else 0
-
-        if success:
-            logger.info(f"[{action}] '{control_key}' at scope '{scope}' — OK")
-        else:
-            logger.warning(f"[{action}] '{control_key}' at scope '{scope}' — success=False")
-
-        if failure_count:
-            logger.warning(f"  {failure_count} issue(s) reported:")
-            for item in issues.get("items", []):
-                logger.warning(f"    [{item.get('account')}] {item.get('message')} (scope: {item.get('scope')})")
-
-        return success
+        return handle_response(action, control_key, scope, response)
     except Exception as e:
         logger.error(f"Error running {action} on '{control_key}' at '{scope}': {e}")
         return False
 
 
+def run_actions_concurrently(action, entries, apply_at_scope, concurrency):
+    # send the mutations on one event loop, at most <concurrency> in flight at once
+    from sonrai_api import aio
+
+    mutation = ACTIONS[action]["mutation"]
+    queries = [(mutation, build_variables(action, key, scope, apply_at_scope)) for key, scope in entries]
+    responses = aio.run_queries(queries, max_in_flight=concurrency, return_exceptions=True)
+
+    results = []
+    for (control_key, scope), response in zip(entries, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            results.append(handle_response(action, control_key, scope, response))
+        except Exception as e:
+            logger.error(f"Error running {action} on '{control_key}' at '{scope}': {e}")
+            results.append(False)
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Bulk apply a CPF service action (disable, protect, unprotect) to a list of control keys at a specified scope.",
@@ -346,6 +373,13 @@ notes:
         default=True,
         help="Sets applyAtScope on disable/protect mutations (default: true). Not used for unprotect."
     )
+    parser.add_argument(
+        "-c", "--concurrency",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of mutations to send concurrently (default: 1, sequential). Requires aiohttp when > 1."
+    )
     parser.add_argument(
         "-n", "--dryrun",
         action="store_true",
@@ -390,13 +424,19 @@ notes:
     succeeded = 0
     failed = 0
 
-    for i, (control_key, scope) in enumerate(entries, start=1):
-        logger.info(f"[{i}/{total}] Processing '{control_key}' at '{scope}'")
-        ok = run_action(args.action, control_key, scope, args.apply_at_scope, args.dryrun)
-        if ok:
-            succeeded += 1
-        else:
-            failed += 1
+    if args.concurrency > 1 and not args.dryrun:
+        logger.info(f"Processing {total} entries with up to {args.concurrency} concurrent requests")
+        outcomes = run_actions_concurrently(args.action, entries, args.apply_at_scope, args.concurrency)
+        succeeded = sum(1 for ok in outcomes if ok)
+        failed = total - succeeded
+    else:
+        for i, (control_key, scope) in enumerate(entries, start=1):
+            logger.info(f"[{i}/{total}] Processing '{control_key}' at '{scope}'")
+            ok = run_action(args.action, control_key, scope, args.apply_at_scope, args.dryrun)
+            if ok:
+                succeeded += 1
+            else:
+                failed += 1
 
     logger.info(f"\nDone. {succeeded} succeeded, {failed} failed out of {total} total.")
 
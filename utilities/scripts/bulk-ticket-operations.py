@@ -1,14 +1,16 @@
 import argparse
 import json
 import sys
-import time
 import pandas as pd
 import urllib.parse
 import datetime
 import re
 from datetime import timedelta, date
 from urllib.parse import urlparse, parse_qs
-from sonrai_api import api, logger
+from sonrai_api import api, logger, SonraiAPIException
+
+# lookups of users, swimlanes and frameworks are reused across runs for this many seconds
+LOOKUP_CACHE_TTL = 3600
 
 
 def build_graphql(q_file):
@@ -29,7 +31,7 @@ def build_graphql(q_file):
 def get_user_srn(email):
     # routine to translate email address to srn
     sonrai_users_query = '''{SonraiUsers {count items {email srn}}}'''
-    user_list = api.execute_query(sonrai_users_query)
+    user_list = api.execute_query(sonrai_users_query, cache_ttl=LOOKUP_CACHE_TTL, query_name="SonraiUsersByEmail")
     user_srn = None
     for user in user_list['data']['SonraiUsers']['items']:
         if user['email'] == email:
@@ -160,62 +162,23 @@ def update_finding_status(action, comment, query, data, snooze_days=None):
 
 def query_findings(query):
     logger.info("Querying Findings")
-    # This is used to loop the findings [findings_per_cycle] at a time until they are all captured
-    offset = 0
-    limit = findings_per_cycle
-    total = 0
-    my_retries = 0
-    count = None
-    results = {}
-    display_count = True
-    while count is None or count == findings_per_cycle:
-        # looping through up to [findings_per_cycle] at a time
-        query_vars = json.dumps({"limit": limit, "offset": offset})
-        logger.debug("querying {} findings, offset: {}".format(limit, offset))
-        success = False
-        
-        while not success:
-            try:
-                data = api.execute_query(query, query_vars)
-                if 'errors' in data:
-                    # check to see if there are any errors in the results, if so stop processing
-                    logger.error("Invalid query {}".format(data))
-                    logger.error("Validate query before proceeding")
-                    sys.exit(104)
-                count = data['data']['ListFindings']['pageCount']
-                globalCount = str(data['data']['ListFindings']['totalCount'])
-                if display_count:
-                    logger.info("Total results matching query: {}".format(globalCount))
-                    display_count = False  # only need to display this once
-                
-                if results == {}:
-                    # this is the first query, so no value in results, just copying the data value into results
-                    results = data.copy()
-                else:
-                    # this is all subsequent passes, where we are extending the results with the data
-                    results['data']['ListFindings']['items'].extend(data['data']['ListFindings']['items'])
-                    results['data']['ListFindings']['pageCount'] += count
-                
-                logger.debug("adding " + str(count) + " findings to the results (" + str(results['data']['ListFindings']['pageCount']) + "/" + globalCount + ")")
-                # logger.debug("success=True")
-                success = True
-            
-            except Exception as e:
-                logger.debug(Exception)
-                logger.debug(e)
-                my_retries += 1
-                if my_retries == 10:
-                    # abandon ship
-                    raise SonraiAPIException("max retries (10) hit - giving up")
-                
-                logger.debug("error, waiting 60 seconds and then retry - " + str(my_retries))
-                time.sleep(60)
-        
-        # upon successful query, reset retries & increment the offset
-        my_retries = 0
-        if count == limit:
-            offset += limit
-    
+    # page through the findings [findings_per_cycle] at a time until they are all captured
+    items = []
+    global_count = None
+    try:
+        for page in api.paginate_pages(query, findings_per_cycle, root_key='ListFindings'):
+            if global_count is None:
+                global_count = page['total']
+                logger.info("Total results matching query: {}".format(global_count))
+            items.extend(page['items'])
+            logger.debug("adding " + str(len(page['items'])) + " findings to the results (" + str(len(items)) + "/" + str(global_count) + ")")
+    except SonraiAPIException as e:
+        # check to see if there are any errors in the results, if so stop processing
+        logger.error("Invalid query {}".format(e))
+        logger.error("Validate query before proceeding")
+        sys.exit(104)
+
+    results = {'data': {'ListFindings': {'items': items, 'pageCount': len(items), 'totalCount': global_count}}}
     logger.info("Total number of results from query: {}".format(results['data']['ListFindings']['pageCount']))
     return results
 
@@ -246,7 +209,7 @@ def convert_framework_srns_to_titles(data):
     # do a lookup of all swimlanes
     logger.info("Converting frameworkSrns to Control Framework Names")
     framework_query = ''' query framework { ControlFrameworks { items { srn title } } }'''
-    framework_json = api.execute_query(framework_query)
+    framework_json = api.execute_query(framework_query, cache_ttl=LOOKUP_CACHE_TTL)
     framework_list = {}
     for framework_obj in framework_json['data']['ControlFrameworks']['items']:
         # build a dict of all the swimlanes srn to title
@@ -286,7 +249,7 @@ def get_sonrai_user_details():
     # do a lookup of the sonrai users details
     logger.info("Getting Sonrai User information")
     sonrai_user_query = '''query sonrai_users { SonraiUsers  { items { srn name email } } }'''
-    sonrai_user_json = api.execute_query(sonrai_user_query)
+    sonrai_user_json = api.execute_query(sonrai_user_query, cache_ttl=LOOKUP_CACHE_TTL)
     user_name_list = {}
     user_email_list = {}
     for user_obj in sonrai_user_json['data']['SonraiUsers']['items']:
@@ -322,7 +285,7 @@ def convert_swimlane_srns_to_names(data):
     # do a lookup of all swimlanes
     logger.info("Converting all swimlane field srns to swimlane titles")
     swimlane_query = ''' query swimlanes { Swimlanes { items { srn title } } }'''
-    swimlanes_json = api.execute_query(swimlane_query)
+    swimlanes_json = api.execute_query(swimlane_query, cache_ttl=LOOKUP_CACHE_TTL)
     swimlane_list = {}
     for swimlane_obj in swimlanes_json['data']['Swimlanes']['items']:
         # build a dict of all the swimlanes srn to title
@@ -205,7 +205,7 @@ def print_skipped_accounts(all_accounts, excluded_accounts):
             print(f" - {acct}")
 
 
-def apply_service_action(action, control_key, scopes, dryrun):
+def apply_service_action(action, control_key, scopes, dryrun, concurrency=1):
     supported = is_action_supported(control_key, action)
     if supported is None:
         return
@@ -244,6 +244,7 @@ def apply_service_action(action, control_key, scopes, dryrun):
 
     print(f"Total accounts to be processed: {len(scopes)}")
 
+    queries = []
     for account, scope in scopes.items():
         query_vars = {
             "input": {
@@ -255,6 +256,8 @@ def apply_service_action(action, control_key, scopes, dryrun):
             query_vars["input"].update({"identities": [], "ssoActorIds": []})
         if dryrun:
             print(f"[DryRun] Would apply '{action}' to '{control_key}' on account {account} ({scope})")
+        elif concurrency > 1:
+            queries.append((mutation, json.dumps(query_vars)))
         else:
             print(f"Applying '{action}' to '{control_key}' on account {account} ({scope})")
             try:
@@ -262,7 +265,18 @@ def apply_service_action(action, control_key, scopes, dryrun):
                 print(response)
             except Exception as e:
                 print(f"Error applying action to account {account}: {e}")
-                
+
+    if queries:
+        # send the mutations on one event loop, at most <concurrency> in flight at once
+        from sonrai_api import aio
+        print(f"Applying '{action}' to '{control_key}' on {len(queries)} accounts, {concurrency} at a time")
+        responses = aio.run_queries(queries, max_in_flight=concurrency, return_exceptions=True)
+        for (account, scope), response in zip(scopes.items(), responses):
+            if isinstance(response, Exception):
+                print(f"Error applying action to account {account}: {response}")
+            else:
+                print(f"{account} ({scope}): {response}")
+
 def pending_changes(scope):
     query = """
         query fetchPendingChangesCount($filters: PendingChangeFilter) {
@@ -305,6 +319,7 @@ def main():
     parser.add_argument("-n", "--dryrun", action="store_true", help="Simulate the action without applying changes")
     parser.add_argument("-l", "--list-status", action="store_true", help="List current status of the control across accounts")
     parser.add_argument("-v", "--verbose", action="store_true", help="Show detailed per-account status when listing")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="Number of accounts to update concurrently (default 1, requires aiohttp above 1)")
     args = parser.parse_args()
 
     if args.search:
@@ -355,7 +370,7 @@ def main():
         print("Error: Must provide either --include-list or --exclude-list")
         return
 
-    apply_service_action(action, args.control_key, scopes, args.dryrun)
+    apply_service_action(action, args.control_key, scopes, args.dryrun, args.concurrency)
 
 
 if __name__ == "__main__":
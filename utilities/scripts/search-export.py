@@ -1,8 +1,7 @@
 import argparse
 import json
 import sys
-import time
-from sonrai_api import api, logger
+from sonrai_api import api, logger, SonraiAPIException
 
 
 def read_graphql_from_file(q_file):
@@ -19,82 +18,55 @@ def read_graphql_from_file(q_file):
     return query_from_file
 
 
-def run_query(query_to_run):
+def export_query(query_to_run, file_name):
+    # stream the results page by page straight into the JSON file, so memory use stays flat
     logger.info("Running Query")
-    # This is used to loop the results [results_per_cycle] at a time until they are all captured
-    offset = 0
-    limit = results_per_cycle
-    my_retries = 0
-    total_count = None
+    logger.info("Exporting result to JSON file: {}".format(file_name))
     running_count = 0
-    results = {}
+    total_count = None
     top_key = None
-    while total_count is None or running_count < total_count:
-        # looping through up to [results_per_cycle] at a time
-        query_vars = json.dumps({"limit": limit, "offset": offset})
-        logger.debug("querying {} results, offset: {}".format(limit, offset))
-        success = False
-        
-        while not success:
-            try:
-                data = api.execute_query(query_to_run, query_vars)
-                if 'errors' in data:
-                    # check to see if there are any errors in the results, if so stop processing
-                    logger.error("Invalid query {}".format(data))
-                    logger.error("Validate query before proceeding")
-                    sys.exit(104)
-                
-                if results == {}:
-                    # this is the first query, so no value in results, just copying the data value into results
-                    results = data.copy()
-                    top_key = list(data['data'].keys())[0]
-                    current_count = len(data['data'][top_key]['items'])
-                    total_count = data['data'][top_key]['count']
-                else:
-                    # this is all subsequent passes, where we are extending the results with the data
-                    results['data'][top_key]['items'].extend(data['data'][top_key]['items'])
-                    current_count = len(data['data'][top_key]['items'])
-                
-                running_count += current_count
-                logger.debug("adding {} {} records to the results ( {} / {} )".format(current_count, top_key, running_count, total_count))
-                # logger.debug("success=True")
-                success = True
-            
-            except Exception as e:
-                logger.debug(Exception)
-                logger.debug(e)
-                my_retries += 1
-                if my_retries == 10:
-                    # abandon ship
-                    raise SonraiAPIException("max retries (10) hit - giving up")
-                
-                logger.debug("error, waiting 60 seconds and then retry - " + str(my_retries))
-                time.sleep(60)
-            
-        # upon successful query, reset retries & increment the offset
-        my_retries = 0
-        if running_count < total_count:
-            offset += limit
-    
+    with open(file_name, "w") as outfile:
+        for page in paginate_or_exit(query_to_run):
+            if top_key is None:
+                top_key = page['root_key']
+                total_count = page['total']
+                outfile.write('{\n    "data": {\n        ' + json.dumps(top_key) + ': {\n            "items": [')
+            for item in page['items']:
+                if running_count:
+                    outfile.write(",")
+                outfile.write("\n" + indent_text(json.dumps(item, indent=4), 16))
+                running_count += 1
+            logger.debug("adding {} {} records to the results ( {} / {} )".format(len(page['items']), top_key, running_count, total_count))
+
+        outfile.write("\n            ],\n            \"count\": " + json.dumps(total_count if total_count is not None else running_count))
+        outfile.write("\n        }\n    }\n}")
+
     logger.info("Total number of results from query: {}".format(running_count))
-    return results
+    return running_count
+
+
+def paginate_or_exit(query_to_run):
+    try:
+        yield from api.paginate_pages(query_to_run, results_per_cycle, workers=args.workers)
+    except SonraiAPIException as e:
+        # check to see if there are any errors in the results, if so stop processing
+        logger.error("Invalid query {}".format(e))
+        logger.error("Validate query before proceeding")
+        sys.exit(104)
+
+
+def indent_text(text, spaces):
+    pad = " " * spaces
+    return "\n".join(pad + line for line in text.splitlines())
 
 
-def export_to_file(data):
-    # export data
-    # export to JSON (default)
-    logger.info("Exporting result to JSON file: {}".format(args.file))
-    json_object = json.dumps(data, indent=4)
-    with open(args.file, "w") as outfile:
-        outfile.write(json_object)
-            
-            
 # main
 # Create the parser
 parser = argparse.ArgumentParser(description='This script will take an advance search and export to a file')
 # Add the command line options
 parser.add_argument('-q', '--query', type=str, required=True, help='File containing graphQL query advanced search')
 parser.add_argument('-l', '--limit', type=int, default=1000, help='The limit of results to be pulled with each pass. DEFAULT = 1000')
+parser.add_argument('-w', '--workers', type=int, default=1, help='Number of pages to fetch in parallel once the total count is known. DEFAULT = 1')
 parser.add_argument('-f', '--file', type=str, metavar="FILE", required=True, help='Export results to <FILE>. Default format is JSON')
 # Parse the command line options
 args = parser.parse_args()
@@ -105,8 +77,5 @@ results_per_cycle = args.limit
 # load query from file
 query = read_graphql_from_file(args.query)
 
-# gather the list of results based on the filter
-response = run_query(query)
-
-# save results from finding query
-export_to_file(response)
+# gather the list of results based on the filter and save them as they arrive
+export_query(query, args.file)
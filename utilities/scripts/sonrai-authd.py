@@ -0,0 +1,21 @@
+import argparse
+import signal
+import sys
+from sonrai_api import authd, logger, SonraiAPIException
+
+# Long running token broker for the scripts in this folder, see the sonrai_api README (authd.py).
+# Start it once, e.g. from systemd or in the background, and every script on the host using the same
+# socket gets its token from it instead of reading and renewing the token file itself.
+
+parser = argparse.ArgumentParser(description='Serve the Sonrai API token to local scripts over a Unix socket')
+parser.add_argument('-s', '--socket', type=str, default=None, help='Path of the Unix socket. DEFAULT = authd_socket from config.json')
+args = parser.parse_args()
+
+# stop cleanly (removing the socket) when a service manager sends SIGTERM
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+try:
+    authd.serve(args.socket)
+except SonraiAPIException as e:
+    logger.error(e)
+    sys.exit(1)
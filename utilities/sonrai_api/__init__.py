@@ -2,11 +2,8 @@ import logging
 import sys
 import json
 
-from sonrai_api import token
-
 # globals
 logger = logging.getLogger("sonrai_api")
-api_token = token.verify_token()
 
 # Create the Logger for use with all modules
 # https://docs.python.org/3/library/logging.html#logrecord-objects
@@ -38,6 +35,21 @@ class SonraiAPIException(Exception):
     pass
 
 
+class SonraiQueryLimitException(SonraiAPIException):
+    """Raised when the server reports the GRPC query size limit"""
+    pass
+
+
 # Set level according to the config file.
 level = logging.getLevelName(config['sonrai-token-log-level'])
 logger.setLevel(level)
+
+# the token module needs config and the exceptions above
+from sonrai_api import token  # noqa: E402
+
+
+def __getattr__(name):
+    # sonrai_api.api_token is resolved on first access, so importing the library does not authenticate
+    if name == "api_token":
+        return token.get_api_token()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
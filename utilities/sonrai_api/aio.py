@@ -0,0 +1,162 @@
+import asyncio
+import json
+
+from sonrai_api import cassette, config, logger, metrics, token, ratelimit, retry, SonraiAPIException
+from sonrai_api.api import query_name_for, _auth_header, _final_response, _parse_response, _reauthenticate
+
+# asyncio client for the Sonrai GraphQL API.
+# This module needs the optional aiohttp library:  pip3 install aiohttp
+#
+#   from sonrai_api import aio
+#   results = aio.run_queries([(query, variables), ...], max_in_flight=20)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# one pooled ClientSession per event loop, created on first use
+_async_session = None
+_async_session_loop = None
+
+
+def get_async_session():
+    # aiohttp sessions are bound to the loop that created them, so a new loop gets a new pool
+    global _async_session, _async_session_loop
+
+    if aiohttp is None:
+        raise SonraiAPIException("The asyncio client requires aiohttp - pip3 install aiohttp")
+
+    _loop = asyncio.get_running_loop()
+    if _async_session is None or _async_session.closed or _async_session_loop is not _loop:
+        _connector = aiohttp.TCPConnector(
+            limit=int(config.get('pool_maxsize', 10)),
+            ssl=False if config['verify_ssl'] == 0 else None,
+            force_close=config.get('keep_alive', 1) == 0
+        )
+        _async_session = aiohttp.ClientSession(
+            connector=_connector,
+            timeout=aiohttp.ClientTimeout(total=config['query_timeout'])
+        )
+        _async_session_loop = _loop
+        logger.debug("created asyncio connection pool")
+
+    return _async_session
+
+
+async def close_async_session():
+    global _async_session
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+    _async_session = None
+
+
+async def execute_query_async(query=None, variables="{}", query_name=None):
+    # coroutine version of api.execute_query - same token, retry policy, error mapping, cassette and query name
+    if query and cassette.replaying():
+        return _parse_response(*cassette.replay(query, variables))
+
+    _attempt = 0
+    _reauthenticated = False
+    _variables = json.loads(variables)
+    _http = get_async_session()
+    _policy = retry.default_policy()
+
+    if query:
+        _kind = ratelimit.request_kind(query)
+        _query_name = query_name_for(query, query_name)
+        _call = metrics.start(_query_name)
+        # only a new request is refused while the breaker is open.  A retry already in progress waits out the
+        # cooldown in its delay (RetryPolicy.delay), even when another worker's failure re-opens the breaker
+        try:
+            _policy.breaker.before_request()
+        except retry.SonraiCircuitOpenException:
+            _call.failed()
+            raise
+        while True:
+            _call.waited(await ratelimit.acquire_async(_kind))
+            _status = None
+            _text = None
+            _body = None
+            _retry_after = None
+            _headers = _auth_header(_query_name)
+
+            try:
+                async with _http.post(
+                    token.get_api_token()['sonrai_url'],
+                    data=json.dumps({"query": query, "variables": _variables}),
+                    headers=_headers,
+                    proxy=config['proxy_server'] or None
+                ) as _response:
+                    _text = await _response.text()
+                    _retry_header = _response.headers.get("Retry-After")
+                    # set once the whole body is in, a read that fails half way is retried like a connection error
+                    _status = _response.status
+
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+                _reason = "{} - {}".format(type(e).__name__, str(e))
+
+            except Exception as e:
+                _call.failed()
+                raise SonraiAPIException("There was a problem communicating with Sonrai - ", str(e))
+
+            else:
+                if _status == 401 and not _reauthenticated:
+                    _reauthenticated = True
+                    # renewal is a blocking request, keep it off the event loop
+                    if await asyncio.get_running_loop().run_in_executor(None, _reauthenticate, _headers):
+                        continue
+                try:
+                    _body = json.loads(_text)
+                except ValueError:
+                    _body = _text
+                if not _policy.retryable_status(_status, _body):
+                    _policy.breaker.record_success()
+                    _call.done(_status, _body, len(_text.encode("utf-8")))
+                    return _final_response(query, _variables, _status, _body)
+                _reason = "HTTP {}".format(_status)
+                if _status in (429, 503):
+                    _retry_after = retry.parse_retry_after(_retry_header)
+
+            _policy.breaker.record_failure()
+            if not _policy.allow_retry(_attempt):
+                logger.debug("failed after {} retries, aborting".format(_attempt))
+                if _status is not None:
+                    _call.done(_status, _body, len(_text.encode("utf-8")))
+                    return _final_response(query, _variables, _status, _body)
+                _call.failed()
+                raise SonraiAPIException("Sonrai API Query failed after {} retries - {}".format(_attempt, _reason))
+
+            _delay = _policy.delay(_attempt, _retry_after)
+            _attempt += 1
+            _call.retry()
+            if _status == 429:
+                _call.waited(_delay)
+            logger.error("*** {}. Sleeping {:.1f} seconds and trying again. Try #{}".format(_reason, _delay, _attempt))
+            await asyncio.sleep(_delay)
+
+
+async def gather_queries(queries, max_in_flight=10, return_exceptions=False):
+    # run many independent queries on one event loop, never more than max_in_flight at a time.
+    # queries is a list of query strings, (query, variables) or (query, variables, query_name) tuples; results
+    # keep the same order.
+    _semaphore = asyncio.Semaphore(max(1, int(max_in_flight)))
+
+    async def _run(item):
+        if isinstance(item, str):
+            item = (item, "{}")
+        async with _semaphore:
+            return await execute_query_async(*item)
+
+    return await asyncio.gather(*[_run(q) for q in queries], return_exceptions=return_exceptions)
+
+
+def run_queries(queries, max_in_flight=10, return_exceptions=False):
+    # synchronous wrapper around gather_queries for scripts that do not run their own event loop
+    async def _main():
+        try:
+            return await gather_queries(queries, max_in_flight, return_exceptions)
+        finally:
+            await close_async_session()
+
+    return asyncio.run(_main())
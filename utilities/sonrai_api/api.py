@@ -1,85 +1,341 @@
-import requests
+import threading
 import time
 import json
 
-from sonrai_api import config, logger, api_token, token, SonraiAPIException
+from sonrai_api import config, logger, token, SonraiAPIException, SonraiQueryLimitException
+from sonrai_api import cache, cassette, graphql, metrics, paging, ratelimit, retry
 
+# requests and concurrent.futures are imported on first use, which keeps `from sonrai_api import api`
+# cheap for scripts that only parse their arguments or do a dry run
 
-def _auth_header():
-    return {
-        "authorization": "Bearer {bearer}".format(bearer=token.token),
-        "Content-type": "application/json",
-        "query-name": "SonraiAPIQuery",
-        "Cache-Control": "no-cache"
-    }
+# sent in the query-name header, server side logs and the metrics are broken down by it.  Used for anonymous
+# queries when the caller gives no query_name
+DEFAULT_QUERY_NAME = "SonraiAPIQuery"
 
+# process-wide pooled session, created on first use
+_session = None
+_session_lock = threading.Lock()
 
-def execute_query(query=None, variables="{}"):
-    _verify = True
-    _proxy = None
-    _complete = None
-    _retries = 0
-    _response = None
-    _variables = json.loads(variables)
+
+def _build_session():
+    # pool sizes, keep-alive, proxy and ssl verification are read from config once
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    _s = requests.Session()
+    _adapter = HTTPAdapter(
+        pool_connections=int(config.get('pool_connections', 10)),
+        pool_maxsize=int(config.get('pool_maxsize', 10)),
+        max_retries=0
+    )
+    _s.mount("https://", _adapter)
+    _s.mount("http://", _adapter)
 
     if config['verify_ssl'] == 0:
-        _verify = False
+        _s.verify = False
         logger.debug("ssl verification disabled by config")
 
     if config['proxy_server']:
-        _proxy = {
+        _s.proxies = {
             "http": config['proxy_server'],
             "https": config['proxy_server']
         }
-        logger.debug("using proxy server: {}".format(config['verify_ssl']))
+        logger.debug("using proxy server: {}".format(config['proxy_server']))
+
+    if config.get('keep_alive', 1) == 0:
+        _s.headers["Connection"] = "close"
+        logger.debug("http keep-alive disabled by config")
+
+    return _s
+
+
+def get_session():
+    # requests.Session is safe to share for concurrent requests, only creation needs the lock
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def query_name_for(query, query_name=None):
+    # the caller's name, else the operation name of the document, else DEFAULT_QUERY_NAME
+    return query_name or graphql.operation_name(query) or DEFAULT_QUERY_NAME
+
+
+def _auth_header(query_name=DEFAULT_QUERY_NAME):
+    return {
+        "authorization": "Bearer {bearer}".format(bearer=token.manager.bearer()),
+        "Content-type": "application/json",
+        "query-name": query_name,
+        "Cache-Control": "no-cache"
+    }
+
+
+def _reauthenticate(headers):
+    # called at most once per request after a 401: renew the token, unless another worker already has,
+    # so the request can be sent again.  returns False when the token could not be renewed
+    try:
+        token.manager.refresh(stale=headers["authorization"][len("Bearer "):])
+    except SonraiAPIException as e:
+        logger.debug("unable to renew the token after a 401 - {}".format(e))
+        return False
+    logger.info("request was rejected with a 401, retrying with a renewed token")
+    return True
+
+
+def execute_query(query=None, variables="{}", cache_ttl=None, query_name=None):
+    # cache_ttl (seconds) opts a read-only query into the response cache, mutations always go to the server.
+    # query_name is sent in the query-name header and keys the metrics, it defaults to the operation name
+    if query and cassette.replaying():
+        return _parse_response(*cassette.replay(query, variables))
+
+    _cache_key = None
+    # while recording every query goes to the server, so the cassette holds what a fresh run sees
+    if query and cache_ttl and cache.enabled() and cache.cacheable(query) and not cassette.recording():
+        _cache_key = cache.make_key(query, variables, token.get_api_token()['org'])
+        _cached = cache.get(_cache_key)
+        if _cached is not None:
+            return _cached
+
+    _result = _send_query(query, variables, query_name)
+
+    if _cache_key and isinstance(_result, dict) and 'errors' not in _result:
+        cache.put(_cache_key, _result, cache_ttl)
+
+    return _result
+
+
+def _fetch_page(query, variables, page_size, offset, root_key, query_name=None):
+    _page_vars = dict(variables or {}, limit=page_size, offset=offset)
+    logger.debug("querying {} results, offset: {}".format(page_size, offset))
+    _data = execute_query(query, json.dumps(_page_vars), query_name=query_name)
+
+    if 'errors' in _data:
+        logger.debug(str(_data['errors']))
+        raise SonraiAPIException("Query returned errors - {}".format(_data['errors'][0].get('message')))
+
+    if root_key is None:
+        root_key = list(_data['data'].keys())[0]
+
+    _root = _data['data'][root_key] or {}
+    _items = _root.get('items') or []
+    _total = _root.get('totalCount', _root.get('count'))
+
+    return {"root_key": root_key, "items": _items, "offset": offset, "total": _total}
+
+
+def paginate_pages(query, page_size=1000, root_key=None, variables="{}", workers=1, ordered=True, adaptive=True,
+                   query_name=None):
+    # generator running a limit/offset query one page at a time.  The query must declare $limit and $offset.
+    # yields {"root_key", "items", "offset", "total", "page_size"} per page; total is None when the query has
+    # no count/totalCount field.  Only the current page is held in memory.
+    # With workers > 1 the remaining pages are fetched concurrently once the first page reports the total;
+    # ordered=False hands pages back as soon as they arrive instead of in offset order.
+    # adaptive sizing (see paging.py) halves the page size on the GRPC query limit error, grows it while pages
+    # stay under the latency target and remembers the result for the next run.  Parallel pages use a fixed size.
+    # With a cassette the sizes do not depend on latency or earlier runs, so a replay asks for the recorded pages.
+    # query_name is passed on to execute_query for every page.
+    if isinstance(variables, str):
+        variables = json.loads(variables or "{}")
+
+    _sizer = paging.PageSizer(query, page_size, learn=not cassette.active()) if adaptive else None
+    _offset = 0
+    _total = None
+
+    try:
+        while True:
+            _size = _sizer.size if _sizer else page_size
+            _started = time.time()
+            try:
+                _page = _fetch_page(query, variables, _size, _offset, root_key, query_name)
+            except SonraiQueryLimitException:
+                if _sizer and _sizer.limit_reached():
+                    continue
+                raise
+
+            _page['page_size'] = _size
+            if _sizer:
+                _sizer.page_done(time.time() - _started)
+            yield _page
+
+            root_key = _page['root_key']
+            _total = _page['total']
+            _returned = len(_page['items'])
+            _offset += _returned
+            # a short page is the last one only when there is no total; with a total it means the server caps the
+            # page size, so paging carries on at the size it returned
+            if _total is None:
+                if _returned < _size:
+                    break
+            elif _offset >= _total or not _returned:
+                break
+            elif _returned < _size:
+                _size = _returned
+                if _sizer:
+                    _sizer.page_capped(_returned)
+
+            if workers > 1 and _total is not None:
+                for _page in _fetch_pages_concurrently(query, variables, _size, root_key, _offset, _total, workers, ordered,
+                                                       query_name):
+                    _page['page_size'] = _size
+                    yield _page
+                break
+    finally:
+        if _sizer:
+            _sizer.save()
+
+
+def _fetch_pages_concurrently(query, variables, page_size, root_key, start, total, workers, ordered, query_name=None):
+    # at most workers * 2 pages are requested ahead of the consumer, which bounds memory use
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    _offsets = iter(range(start, total, page_size))
+    _window = workers * 2
+    _pending = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as _pool:
+        def _submit():
+            for _offset in _offsets:
+                _pending[_offset] = _pool.submit(_fetch_page, query, variables, page_size, _offset, root_key, query_name)
+                if len(_pending) >= _window:
+                    break
+
+        try:
+            _submit()
+            while _pending:
+                if ordered:
+                    _offset = min(_pending)
+                    _page = _pending.pop(_offset).result()
+                else:
+                    _done, _ = wait(_pending.values(), return_when=FIRST_COMPLETED)
+                    _offset = next(o for o, f in _pending.items() if f in _done)
+                    _page = _pending.pop(_offset).result()
+                _submit()
+                yield _page
+        finally:
+            for _future in _pending.values():
+                _future.cancel()
+
+
+def paginate(query, page_size=1000, root_key=None, variables="{}", workers=1, ordered=True, adaptive=True,
+             query_name=None):
+    # generator yielding the items of a limit/offset query one by one, fetching a page at a time
+    for _page in paginate_pages(query, page_size, root_key, variables, workers, ordered, adaptive, query_name):
+        for _item in _page['items']:
+            yield _item
+
+
+def _send_query(query, variables, query_name=None):
+    import requests
+
+    _attempt = 0
+    _reauthenticated = False
+    _variables = json.loads(variables)
+    _http = get_session()
+    _policy = retry.default_policy()
 
     if query:
-        while _retries <= int(config['query_retries']) and not _complete:
+        _kind = ratelimit.request_kind(query)
+        _query_name = query_name_for(query, query_name)
+        _call = metrics.start(_query_name)
+        # only a new request is refused while the breaker is open.  A retry already in progress waits out the
+        # cooldown in its delay (RetryPolicy.delay), even when another worker's failure re-opens the breaker
+        try:
+            _policy.breaker.before_request()
+        except retry.SonraiCircuitOpenException:
+            _call.failed()
+            raise
+        while True:
+            _call.waited(ratelimit.acquire(_kind))
+            _response = None
+            _retry_after = None
+            _headers = _auth_header(_query_name)
 
             try:
-                _response = requests.post(
-                    api_token['sonrai_url'],
+                _response = _http.post(
+                    token.get_api_token()['sonrai_url'],
                     data=json.dumps({"query": query, "variables": _variables}),
-                    headers=_auth_header(),
-                    proxies=_proxy,
-                    timeout=config['query_timeout'],
-                    verify=_verify
+                    headers=_headers,
+                    timeout=config['query_timeout']
                 )
 
-            except requests.exceptions.Timeout:
-                logger.error("*** Request timeout. Sleeping 5 seconds and trying again. Try #{retry}".format(retry=_retries))
-                _retries += 1
-                time.sleep(5)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                _reason = "{} - {}".format(type(e).__name__, str(e))
 
             except Exception as e:
+                _call.failed()
                 raise SonraiAPIException("There was a problem communicating with Sonrai - ", str(e))
 
             else:
-                _complete = True
-
-            if _retries == int(config['query_retries']) and _complete is False:
-                logger.debug("failed after {} retries, aborting".format(config['query_retries']))
-                raise SonraiAPIException("Sonrai API Query Took too long - Aborting")
-
-        if _response.status_code in (404, 403, 402):
-            logger.debug("{status} error - please check your server setting".format(status=str(_response.status_code)))
-            raise SonraiAPIException("*** AUTHENTICATION FAILED ***")
-
-        if _response.status_code == 401:
-            logger.debug("API token expired, please get a new one from the Advanced Search UI.")
-            raise SonraiAPIException("Sonrai Token Expired")
-
-        if _response.status_code == 500:
-            logger.debug(str(_response.json()))
-            raise SonraiAPIException("Sonrai Server 500 Error")
-
-        if "Unexpected exception while fetching Grpc data" in str(_response.json()):
-            logger.debug("GPRC error message received:")
-            logger.debug("This occurs if the query size limit is reached.")
-            logger.debug("Try limiting your query with additional filters & try again.")
-            raise SonraiAPIException("GPRC Error - Query Limit Reached")
-
-        if _response.status_code == 200:
-            return _response.json()
-        else:
-            raise SonraiAPIException(_response.status_code)
+                if _response.status_code == 401 and not _reauthenticated:
+                    _reauthenticated = True
+                    if _reauthenticate(_headers):
+                        continue
+                _body = _decode_body(_response)
+                if not _policy.retryable_status(_response.status_code, _body):
+                    _policy.breaker.record_success()
+                    _call.done(_response.status_code, _body, len(_response.content))
+                    return _final_response(query, _variables, _response.status_code, _body)
+                _reason = "HTTP {}".format(_response.status_code)
+                if _response.status_code in (429, 503):
+                    _retry_after = retry.parse_retry_after(_response.headers.get("Retry-After"))
+
+            _policy.breaker.record_failure()
+            if not _policy.allow_retry(_attempt):
+                logger.debug("failed after {} retries, aborting".format(_attempt))
+                if _response is not None:
+                    _call.done(_response.status_code, _body, len(_response.content))
+                    return _final_response(query, _variables, _response.status_code, _body)
+                _call.failed()
+                raise SonraiAPIException("Sonrai API Query failed after {} retries - {}".format(_attempt, _reason))
+
+            _delay = _policy.delay(_attempt, _retry_after)
+            _attempt += 1
+            _call.retry()
+            if _response is not None and _response.status_code == 429:
+                _call.waited(_delay)
+            logger.error("*** {}. Sleeping {:.1f} seconds and trying again. Try #{}".format(_reason, _delay, _attempt))
+            time.sleep(_delay)
+
+
+def _final_response(query, variables, status_code, body):
+    # the response a request ended with, after any retries.  Recorded to the cassette when recording
+    if cassette.recording():
+        cassette.record(query, variables, status_code, body)
+    return _parse_response(status_code, body)
+
+
+def _decode_body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return response.text
+
+
+def _parse_response(status_code, body):
+    # maps an http status and decoded body onto the result or a SonraiAPIException.
+    # shared by execute_query and the asyncio client so both fail the same way.
+    if status_code in (404, 403, 402):
+        logger.debug("{status} error - please check your server setting".format(status=str(status_code)))
+        raise SonraiAPIException("*** AUTHENTICATION FAILED ***")
+
+    if status_code == 401:
+        logger.debug("API token expired, please get a new one from the Advanced Search UI.")
+        raise SonraiAPIException("Sonrai Token Expired")
+
+    if "Unexpected exception while fetching Grpc data" in str(body):
+        logger.debug("GPRC error message received:")
+        logger.debug("This occurs if the query size limit is reached.")
+        logger.debug("Try limiting your query with additional filters & try again.")
+        raise SonraiQueryLimitException("GPRC Error - Query Limit Reached")
+
+    if status_code == 500:
+        logger.debug(str(body))
+        raise SonraiAPIException("Sonrai Server 500 Error")
+
+    if status_code == 200 and isinstance(body, dict):
+        return body
+    else:
+        raise SonraiAPIException(status_code)
@@ -0,0 +1,26 @@
+import os
+import tempfile
+
+# Atomic replacement of a file shared with other processes (token, response cache, page sizes, metrics).
+# The text goes to a temp file in the same directory, is flushed to disk, then renamed over the target, so a
+# concurrent reader sees either the old file or the new one, never a partial write.
+
+
+def write(path, text, mode=None, dir_mode=0o777, prefix=None):
+    # mode is applied to the file (mkstemp creates it 0600), dir_mode to directories created on the way.
+    # raises OSError, the temp file is removed when the write fails
+    _dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(_dir, mode=dir_mode, exist_ok=True)
+    _fd, _tmp = tempfile.mkstemp(dir=_dir, prefix=prefix or "tmp", suffix=".tmp")
+    try:
+        with os.fdopen(_fd, "w") as _file:
+            _file.write(text)
+            _file.flush()
+            os.fsync(_file.fileno())
+        if mode is not None:
+            os.chmod(_tmp, mode)
+        os.replace(_tmp, path)
+    except OSError:
+        if os.path.exists(_tmp):
+            os.remove(_tmp)
+        raise
@@ -0,0 +1,120 @@
+import json
+import os
+import socket
+import socketserver
+import time
+
+from sonrai_api import config, logger, token, SonraiAPIException
+
+# Local auth broker.  A long running `sonrai-authd` process owns the token (loading, verifying and renewing it
+# through token.TokenManager) and hands the bearer and the decoded claims to other scripts over a Unix socket,
+# so a short script does not have to read the token file, decode the JWT or renew it itself.
+#
+# The protocol is one JSON line each way:
+#   {"op": "get"}                       ->  {"token": ..., "claims": {...}}
+#   {"op": "refresh", "stale": TOKEN}   ->  same, after renewing unless TOKEN was already replaced
+#   on failure                          ->  {"error": "..."}
+#
+# Clients fall back to the token file when no broker is listening.
+
+_CONNECT_TIMEOUT_SECS = 2
+
+
+def socket_path():
+    # SONRAI_API_AUTHD_SOCKET overrides config; an empty value switches the broker off
+    _path = os.environ.get("SONRAI_API_AUTHD_SOCKET", config.get('authd_socket', '/tmp/sonrai/authd.sock'))
+    return os.path.expanduser(_path) if _path else None
+
+
+def _serialize(claims):
+    # human_expires is a datetime, clients rebuild it from exp
+    return {k: v for k, v in claims.items() if k != 'human_expires'}
+
+
+def _answer(request):
+    if request.get("op") == "refresh":
+        token.manager.refresh(stale=request.get("stale"))
+    elif request.get("op") != "get":
+        raise SonraiAPIException("unknown request {}".format(request.get("op")))
+    _bearer = token.manager.bearer()
+    return {"token": _bearer, "claims": _serialize(token.manager.claims())}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for _line in self.rfile:
+            try:
+                _response = _answer(json.loads(_line))
+            except (ValueError, SonraiAPIException) as e:
+                _response = {"error": str(e)}
+            self.wfile.write(json.dumps(_response).encode("utf-8") + b"\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path=None):
+    # run the broker in the foreground until interrupted
+    path = path or socket_path()
+    if not path:
+        raise SonraiAPIException("No socket configured for the auth broker")
+
+    os.makedirs(os.path.dirname(path) or ".", mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        if request(path=path) is not None:
+            raise SonraiAPIException("An auth broker is already listening on {}".format(path))
+        os.remove(path)
+
+    # load (and if needed renew) the token before accepting connections, this may prompt for a token
+    token.manager.claims()
+
+    # only the owner may connect, the socket hands out the bearer token
+    _umask = os.umask(0o177)
+    try:
+        _server = _Server(path, _Handler)
+    finally:
+        os.umask(_umask)
+
+    logger.info("auth broker listening on {}".format(path))
+    try:
+        _server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _server.server_close()
+        token.manager.stop()
+        if os.path.exists(path):
+            os.remove(path)
+        logger.info("auth broker stopped")
+
+
+def request(op="get", stale=None, path=None):
+    # ask the broker for the current token; returns {"token", "claims"} or None when no broker answers or it
+    # answers with an error
+    path = path or socket_path()
+    if not path or not os.path.exists(path):
+        return None
+
+    _started = time.time()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _sock:
+            _sock.settimeout(_CONNECT_TIMEOUT_SECS)
+            _sock.connect(path)
+            _sock.sendall(json.dumps({"op": op, "stale": stale}).encode("utf-8") + b"\n")
+            with _sock.makefile("rb") as _reader:
+                _response = json.loads(_reader.readline())
+    except (OSError, ValueError) as e:
+        logger.debug("auth broker at {} is not available - {}".format(path, e))
+        return None
+
+    # a broker that cannot help (e.g. its own refresh failed) is treated like no broker, the caller falls back to
+    # the token store
+    if not isinstance(_response, dict) or "error" in _response or "token" not in _response:
+        logger.debug("auth broker at {} answered with an error - {}".format(
+            path, _response.get("error") if isinstance(_response, dict) else _response))
+        return None
+
+    logger.debug("token from auth broker in {:.0f}us".format((time.time() - _started) * 1000000))
+    return _response
@@ -0,0 +1,183 @@
+import json
+import re
+
+from sonrai_api import config, logger, SonraiAPIException
+from sonrai_api import api, graphql
+
+# Packs many single-field queries or mutations into aliased GraphQL documents.
+#
+#   from sonrai_api import batch
+#   results = batch.execute_batch([(mutation, variables), ...])
+#
+# Each operation must be a single query or mutation with one root field, e.g.
+#   mutation addAccount($input: PlatformcloudaccountCreator!) { CreatePlatformcloudaccount(value: $input) { srn } }
+# The operations are sent as
+#   mutation SonraiAPIBatch($b0_input: ..., $b1_input: ...) { b0: CreatePlatformcloudaccount(...) b1: ... }
+# and every caller gets back a response shaped as if its operation had been sent on its own.
+#
+# When the server rejects a whole batch (a validation error, a 500, the GRPC limit ...) the batch is
+# split in half and each half retried, down to single operations, so one bad item does not fail the rest.
+# Errors the server attributes to one alias are handed to that operation only and never re-executed.
+# A mutation batch is only split when the server answered without any data: after an exception (the server may
+# have applied it before a timeout) or with partial data, it is not sent again and every operation gets the
+# exception, or its own data with the errors.
+#
+# The query-name header of a batch is the operation name shared by its operations with "Batch" appended
+# (e.g. addAccountBatch), or SonraiAPIBatch when they differ, unless execute_batch is given a query_name.
+
+
+def _prepare(index, query, variables):
+    # rewrite one operation so it can live next to others in the same document
+    if isinstance(variables, str):
+        variables = json.loads(variables or "{}")
+    variables = variables or {}
+
+    _type, _defs, _selection = graphql.split_operation(query)
+    if _type not in ("query", "mutation"):
+        raise SonraiAPIException("Only queries and mutations can be batched")
+    _fields = graphql.root_fields(_selection)
+    if len(_fields) != 1:
+        # only the first field would be aliased and read back, the others would be lost
+        raise SonraiAPIException("Only operations with a single root field can be batched, found {}".format(
+            ", ".join(_alias or _field for _alias, _field in _fields)))
+    _alias, _field = _fields[0]
+    _prefix = "b{}".format(index)
+
+    for _name in graphql.variable_names(_defs):
+        _pattern = re.compile(r'\$' + _name + r'\b')
+        _defs = _pattern.sub("$" + _prefix + "_" + _name, _defs)
+        _selection = _pattern.sub("$" + _prefix + "_" + _name, _selection)
+
+    _selection = re.sub(r'^\s*(?:[_A-Za-z][_0-9A-Za-z]*\s*:\s*)?', _prefix + ": ", _selection, count=1)
+
+    return {
+        "index": index,
+        "name": graphql.operation_name(query),
+        "type": _type,
+        "alias": _prefix,
+        "key": _alias or _field,
+        "definitions": _defs,
+        "selection": _selection,
+        "variables": {_prefix + "_" + k: v for k, v in variables.items()}
+    }
+
+
+def _build_document(ops):
+    _defs = ", ".join(op["definitions"] for op in ops if op["definitions"])
+    _header = "{} SonraiAPIBatch".format(ops[0]["type"])
+    if _defs:
+        _header += "(" + _defs + ")"
+
+    _variables = {}
+    for op in ops:
+        _variables.update(op["variables"])
+
+    return _header + " { " + " ".join(op["selection"] for op in ops) + " }", _variables
+
+
+def _batch_query_name(ops):
+    _names = {op["name"] for op in ops}
+    if len(_names) == 1 and None not in _names:
+        return _names.pop() + "Batch"
+    return "SonraiAPIBatch"
+
+
+def _request_size(ops):
+    _query, _variables = _build_document(ops)
+    return len(json.dumps({"query": _query, "variables": _variables}))
+
+
+def _chunks(ops, max_aliases, max_bytes):
+    # greedily fill batches up to the alias and byte budgets; an oversized single operation goes alone
+    _current = []
+    for op in ops:
+        if _current and (len(_current) >= max_aliases or _request_size(_current + [op]) > max_bytes):
+            yield _current
+            _current = []
+        _current.append(op)
+    if _current:
+        yield _current
+
+
+def _single_result(op, response, aliases):
+    # cut one alias out of a batched response, restoring the caller's own field name.  Errors the server did not
+    # attribute to any alias of the batch are handed to every operation
+    _result = {"data": {op["key"]: (response.get("data") or {}).get(op["alias"])}}
+    _errors = []
+    for _error in response.get("errors") or []:
+        _path = _error.get("path") or []
+        if _path and _path[0] == op["alias"]:
+            _errors.append(dict(_error, path=[op["key"]] + list(_path[1:])))
+        elif not _path or _path[0] not in aliases:
+            _errors.append(_error)
+    if _errors:
+        _result["errors"] = _errors
+    return _result
+
+
+def _split(ops, results, return_exceptions, query_name):
+    _half = len(ops) // 2
+    logger.debug("batch of {} failed, splitting into {} and {}".format(len(ops), _half, len(ops) - _half))
+    _run(ops[:_half], results, return_exceptions, query_name)
+    _run(ops[_half:], results, return_exceptions, query_name)
+
+
+def _run(ops, results, return_exceptions, query_name=None):
+    _query, _variables = _build_document(ops)
+    _aliases = {op["alias"] for op in ops}
+    _mutation = ops[0]["type"] == "mutation"
+
+    try:
+        _response = api.execute_query(_query, json.dumps(_variables), query_name=query_name or _batch_query_name(ops))
+    except SonraiAPIException as e:
+        # a mutation batch may have been applied before the error (e.g. a timeout after the server took it), so it
+        # is never sent again - every operation gets the exception
+        if len(ops) > 1 and not _mutation:
+            _split(ops, results, return_exceptions, query_name)
+            return
+        if not return_exceptions:
+            raise
+        for op in ops:
+            results[op["index"]] = e
+        return
+
+    _errors = _response.get("errors") or []
+    _attributed = all((e.get("path") or [None])[0] in _aliases for e in _errors)
+    # a mutation batch that returned data has run, resending any part of it would run those mutations twice
+    _rejected = _response.get("data") is None or (not _attributed and not _mutation)
+
+    if _rejected and len(ops) > 1:
+        _split(ops, results, return_exceptions, query_name)
+        return
+
+    if _rejected:
+        # a lone operation that was rejected as a whole - pass the server response through untouched
+        results[ops[0]["index"]] = _response
+        return
+
+    for op in ops:
+        results[op["index"]] = _single_result(op, _response, _aliases)
+
+
+def execute_batch(operations, max_aliases=None, max_bytes=None, return_exceptions=False, query_name=None):
+    # operations is a list of query strings or (query, variables) tuples; results keep the same order.
+    # queries and mutations are never mixed in one document.
+    if max_aliases is None:
+        max_aliases = int(config.get('batch_max_aliases', 50))
+    if max_bytes is None:
+        max_bytes = int(config.get('batch_max_bytes', 262144))
+
+    _prepared = []
+    for _index, _item in enumerate(operations):
+        if isinstance(_item, str):
+            _item = (_item, "{}")
+        _prepared.append(_prepare(_index, *_item))
+
+    _results = [None] * len(_prepared)
+    for _type in ("query", "mutation"):
+        _ops = [op for op in _prepared if op["type"] == _type]
+        for _batch in _chunks(_ops, max(1, max_aliases), max_bytes):
+            logger.debug("sending batch of {} {} operation(s)".format(len(_batch), _type))
+            _run(_batch, _results, return_exceptions, query_name)
+
+    return _results
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from sonrai_api import atomicfile, config, logger, graphql
+
+# Opt-in response cache for read-only queries, used through api.execute_query(..., cache_ttl=SECONDS).
+# Entries live in an in-memory LRU and in an on-disk tier (config['cache_dir']) so that repeated
+# script runs can reuse them until they expire. Mutations are never cached.
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def _cache_dir():
+    return os.path.expanduser(config.get('cache_dir', '/tmp/sonrai/cache'))
+
+
+def enabled():
+    return config.get('cache_enabled', 1) != 0
+
+
+def cacheable(query):
+    return graphql.operation_type(query) == "query"
+
+
+def make_key(query, variables, org):
+    # normalized query text + canonical variables + org, so formatting differences still hit
+    if isinstance(variables, str):
+        variables = json.loads(variables or "{}")
+    _raw = json.dumps([graphql.normalize(query), variables or {}, org], sort_keys=True)
+    return hashlib.sha256(_raw.encode("utf-8")).hexdigest()
+
+
+def get(key):
+    _now = time.time()
+
+    with _memory_lock:
+        _entry = _memory.get(key)
+        if _entry is not None:
+            if _entry[0] > _now:
+                _memory.move_to_end(key)
+                logger.debug("cache hit (memory): {}".format(key))
+                return json.loads(_entry[1])
+            del _memory[key]
+
+    _path = os.path.join(_cache_dir(), key + ".json")
+    try:
+        with open(_path, "r") as _file:
+            _entry = json.load(_file)
+    except (OSError, ValueError):
+        return None
+
+    if _entry.get("expires", 0) <= _now:
+        try:
+            os.remove(_path)
+        except OSError:
+            pass
+        return None
+
+    logger.debug("cache hit (disk): {}".format(key))
+    _remember(key, _entry["expires"], json.dumps(_entry["response"]))
+    return _entry["response"]
+
+
+def put(key, response, ttl):
+    # entries are kept serialized, so callers that modify a result never change the cached copy
+    _expires = time.time() + ttl
+    _text = json.dumps(response)
+    _remember(key, _expires, _text)
+
+    # replaced atomically, a concurrent reader never sees a partial entry
+    try:
+        atomicfile.write(os.path.join(_cache_dir(), key + ".json"),
+                         '{"expires": ' + repr(_expires) + ', "response": ' + _text + '}', dir_mode=0o700)
+    except OSError as e:
+        logger.debug("unable to write cache entry to disk: {}".format(e))
+
+
+def _remember(key, expires, text):
+    with _memory_lock:
+        _memory[key] = (expires, text)
+        _memory.move_to_end(key)
+        while len(_memory) > int(config.get('cache_max_entries', 256)):
+            _memory.popitem(last=False)
+
+
+def clear():
+    # drop both tiers
+    with _memory_lock:
+        _memory.clear()
+    _dir = _cache_dir()
+    if os.path.isdir(_dir):
+        for _name in os.listdir(_dir):
+            if _name.endswith(".json"):
+                try:
+                    os.remove(os.path.join(_dir, _name))
+                except OSError:
+                    pass
@@ -0,0 +1,127 @@
+import atexit
+import gzip
+import json
+import os
+import threading
+import zlib
+
+from sonrai_api import logger, graphql, SonraiAPIException
+
+# Record / replay of API responses, so scripts can be profiled offline on real-shaped data.
+#
+#   SONRAI_API_CASSETTE=FILE SONRAI_API_CASSETTE_MODE=record   append every request and its response to FILE
+#   SONRAI_API_CASSETTE=FILE SONRAI_API_CASSETTE_MODE=replay   answer every request from FILE, nothing is sent
+#   SONRAI_API_CASSETTE_MATCH=query                            on replay, fall back to matching on the query alone
+#
+# FILE is gzip compressed, one request per line: the request as JSON, a tab, then the response as JSON.
+# Requests are matched on the normalized query and the variables, a request with other variables is a miss unless
+# SONRAI_API_CASSETTE_MATCH=query (for variables that change from run to run, e.g. a timestamp - never for paging,
+# every offset would get the same page).  A request recorded several times is answered with its responses in the
+# recorded order, the last one repeating.
+
+MODES = ("record", "replay")
+MATCHES = ("exact", "query")
+
+_path = os.environ.get("SONRAI_API_CASSETTE")
+_mode = os.environ.get("SONRAI_API_CASSETTE_MODE", "replay").lower() if _path else None
+_match = os.environ.get("SONRAI_API_CASSETTE_MATCH", "exact").lower()
+_lock = threading.Lock()
+_writer = None
+_recorded = None
+
+if _mode is not None and _mode not in MODES:
+    raise SonraiAPIException("SONRAI_API_CASSETTE_MODE must be one of {}, not {}".format(", ".join(MODES), _mode))
+if _match not in MATCHES:
+    raise SonraiAPIException("SONRAI_API_CASSETTE_MATCH must be one of {}, not {}".format(", ".join(MATCHES), _match))
+
+
+def active():
+    return _mode is not None
+
+
+def recording():
+    return _mode == "record"
+
+
+def replaying():
+    return _mode == "replay"
+
+
+def _key(query, variables):
+    if isinstance(variables, str):
+        variables = json.loads(variables or "{}")
+    return json.dumps([graphql.normalize(query), variables or {}], sort_keys=True)
+
+
+def record(query, variables, status_code, body):
+    # appends one request and the final response (after retries) to the cassette.  Requests for a new token
+    # are left out, a cassette never holds credentials
+    global _writer
+    if "GenerateSonraiUserToken" in query:
+        return
+    if isinstance(variables, str):
+        variables = json.loads(variables or "{}")
+    _line = "{}\t{}\n".format(
+        json.dumps({"query_name": graphql.operation_name(query), "query": query, "variables": variables or {}, "status": status_code}),
+        json.dumps(body)
+    )
+    with _lock:
+        if _writer is None:
+            _dir = os.path.dirname(os.path.abspath(_path))
+            os.makedirs(_dir, exist_ok=True)
+            _writer = gzip.open(_path, "at", encoding="utf-8")
+            atexit.register(close)
+            logger.info("recording responses to {}".format(_path))
+        _writer.write(_line)
+
+
+def close():
+    global _writer
+    with _lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+
+
+def _load():
+    # two indexes of [recorded (status, compressed response), ...] and the position of the next one to serve:
+    # by query and variables, and by query alone for SONRAI_API_CASSETTE_MATCH=query.  Responses are kept compressed, a cassette of a large export stays small until it is replayed
+    _exact = {}
+    _by_query = {}
+    try:
+        with gzip.open(_path, "rt", encoding="utf-8") as _file:
+            for _line in _file:
+                _request, _, _response = _line.rstrip("\n").partition("\t")
+                _request = json.loads(_request)
+                _recording = (_request["status"], zlib.compress(_response.encode("utf-8"), 1))
+                _exact.setdefault(_key(_request["query"], _request["variables"]), [[], 0])[0].append(_recording)
+                _by_query.setdefault(graphql.normalize(_request["query"]), [[], 0])[0].append(_recording)
+    except (OSError, EOFError, ValueError, KeyError) as e:
+        raise SonraiAPIException("Unable to read the cassette {} - {}".format(_path, e))
+    logger.info("replaying {} recorded requests from {}".format(sum(len(_e[0]) for _e in _exact.values()), _path))
+    return _exact, _by_query
+
+
+def _next_recording(entry):
+    _responses, _next = entry
+    entry[1] = _next + 1
+    return _responses[min(_next, len(_responses) - 1)]
+
+
+def replay(query, variables):
+    # returns the recorded (status code, body) for the request
+    global _recorded
+    with _lock:
+        if _recorded is None:
+            _recorded = _load()
+        _exact, _by_query = _recorded
+        _entry = _exact.get(_key(query, variables))
+        if _entry is None and _match == "query":
+            _entry = _by_query.get(graphql.normalize(query))
+            if _entry is not None:
+                logger.debug("no recording with these variables, replaying the next response recorded for the query")
+        if _entry is None:
+            raise SonraiAPIException("No recorded response in {} for {} with these variables".format(
+                _path, graphql.operation_name(query) or "the query"))
+        _status, _body = _next_recording(_entry)
+    return _status, json.loads(zlib.decompress(_body))
@@ -0,0 +1,113 @@
+import argparse
+import os
+import runpy
+import shlex
+import sys
+
+from sonrai_api import logger
+
+# One process for the scripts in utilities/scripts.  `sonrai <command> [args]` runs the matching script
+# in this interpreter, and `sonrai run-pipeline FILE` runs several of them one after the other, so they share
+# the imported sonrai_api modules: the token is loaded and verified once, and the pooled HTTP session, the
+# query cache and the page size store are reused by every step.
+#
+#   sonrai export -q query.graphql -f out.json
+#   sonrai run-pipeline nightly.txt
+
+COMMANDS = {
+    "approvers": "cpf-approvers.py",
+    "authd": "sonrai-authd.py",
+    "export": "search-export.py",
+    "invite-users": "cpf-invite-sonrai-users.py",
+    "migrate-controls": "cpf-migrate-controls.py",
+    "pagerduty-oncall": "pagerduty-oncall-schedule-query.py",
+    "pagerduty-sync": "pagerduty-sync-to-cpf-approvers-at-scope.py",
+    "quotas": "CMPQuotas.py",
+    "service-action": "bulk-service-action.py",
+    "service-control": "cpf-service-control.py",
+    "swimlanes": "swimlane-maintenance.py",
+    "tickets": "bulk-ticket-operations.py",
+}
+
+
+def _exit_code(code):
+    # same mapping the interpreter uses for SystemExit
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def run_script(path, argv):
+    # run a script as __main__ in this process and return its exit code
+    _argv = sys.argv
+    _dir = os.path.dirname(os.path.abspath(path))
+    if _dir not in sys.path:
+        sys.path.insert(0, _dir)
+
+    sys.argv = [path] + list(argv)
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as e:
+        return _exit_code(e.code)
+    except Exception:
+        logger.exception("{} failed".format(os.path.basename(path)))
+        return 1
+    finally:
+        sys.argv = _argv
+    return 0
+
+
+def run_command(argv, scripts_dir):
+    # argv is a subcommand followed by the arguments for its script
+    if not argv or argv[0] not in COMMANDS:
+        logger.error("Unknown command {} - see sonrai --help".format(argv[0] if argv else ""))
+        return 2
+    print("Running: {}".format(" ".join(shlex.quote(_part) for _part in argv)))
+    return run_script(os.path.join(scripts_dir, COMMANDS[argv[0]]), argv[1:])
+
+
+def read_pipeline(file_name):
+    # one command line per line, blank lines and lines starting with # are skipped
+    _source = sys.stdin if file_name == "-" else open(file_name, "r")
+    try:
+        return [shlex.split(_line) for _line in _source if _line.strip() and not _line.lstrip().startswith("#")]
+    finally:
+        if _source is not sys.stdin:
+            _source.close()
+
+
+def run_pipeline(steps, scripts_dir, keep_going=False):
+    # run each step in turn, stopping at the first failure unless keep_going is set
+    _rc = 0
+    for _step in steps:
+        _step_rc = run_command(_step, scripts_dir)
+        if _step_rc != 0:
+            _rc = _step_rc
+            if not keep_going:
+                break
+    return _rc
+
+
+def main(argv, scripts_dir):
+    _commands = "\n".join("  {:<18} {}".format(_name, _script) for _name, _script in sorted(COMMANDS.items()))
+    parser = argparse.ArgumentParser(
+        prog="sonrai",
+        description="Run the Sonrai scripts in one process",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + _commands + "\n  {:<18} {}".format("run-pipeline", "run the commands listed in a file, one per line")
+    )
+    parser.add_argument('command', help='Command to run, "<command> --help" shows its options')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Arguments for the command')
+    args = parser.parse_args(argv)
+
+    if args.command != "run-pipeline":
+        return run_command([args.command] + args.args, scripts_dir)
+
+    pipeline_parser = argparse.ArgumentParser(prog="sonrai run-pipeline", description="Run the commands listed in a file, one per line")
+    pipeline_parser.add_argument('file', help='File with one command line per line, - for stdin')
+    pipeline_parser.add_argument('-k', '--keep-going', action='store_true', help='Run the remaining steps after a step fails')
+    pipeline_args = pipeline_parser.parse_args(args.args)
+    return run_pipeline(read_pipeline(pipeline_args.file), scripts_dir, pipeline_args.keep_going)
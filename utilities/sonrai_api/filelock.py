@@ -0,0 +1,27 @@
+import os
+
+from contextlib import contextmanager
+
+# Advisory file locks shared by every process on the host that uses the same lock file.
+# fcntl is only available on POSIX systems; elsewhere the lock is a no-op.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+@contextmanager
+def locked(path, exclusive=True):
+    # holds a flock on <path> (created if needed) for the duration of the with block
+    _dir = os.path.dirname(path)
+    if _dir:
+        os.makedirs(_dir, mode=0o700, exist_ok=True)
+    _file = open(path, "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(_file.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield _file
+    finally:
+        if fcntl is not None:
+            fcntl.flock(_file.fileno(), fcntl.LOCK_UN)
+        _file.close()
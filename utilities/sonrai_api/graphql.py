@@ -0,0 +1,145 @@
+import re
+
+from sonrai_api import SonraiAPIException
+
+# Small helpers for looking at GraphQL documents without a full parser.
+# Only the parts the library needs are handled: the operation type / name,
+# the variable definitions and the top level selection set.
+
+_HEADER_RE = re.compile(r'^(query|mutation|subscription)\b\s*([_A-Za-z][_0-9A-Za-z]*)?')
+_ROOT_FIELD_RE = re.compile(r'^\s*(?:([_A-Za-z][_0-9A-Za-z]*)\s*:\s*)?([_A-Za-z][_0-9A-Za-z]*)')
+_FIELD_RE = re.compile(r'[\s,]*(?:([_A-Za-z][_0-9A-Za-z]*)\s*:\s*)?([_A-Za-z][_0-9A-Za-z]*)\s*')
+_DIRECTIVE_RE = re.compile(r'@[_A-Za-z][_0-9A-Za-z]*\s*')
+
+
+def strip_comments(query):
+    # remove '#' comments that are not inside a string
+    _out = []
+    _in_string = False
+    _i = 0
+    while _i < len(query):
+        _c = query[_i]
+        if _in_string:
+            _out.append(_c)
+            if _c == '\\' and _i + 1 < len(query):
+                _out.append(query[_i + 1])
+                _i += 1
+            elif _c == '"':
+                _in_string = False
+        elif _c == '"':
+            _in_string = True
+            _out.append(_c)
+        elif _c == '#':
+            while _i < len(query) and query[_i] != '\n':
+                _i += 1
+            continue
+        else:
+            _out.append(_c)
+        _i += 1
+    return "".join(_out)
+
+
+def normalize(query):
+    # comment free, whitespace collapsed version of the document (used for cache keys and comparisons)
+    return " ".join(strip_comments(query).split())
+
+
+def operation_type(query):
+    # 'query', 'mutation' or 'subscription' - the shorthand '{ ... }' form is a query
+    _match = _HEADER_RE.match(strip_comments(query).strip())
+    return _match.group(1) if _match else "query"
+
+
+def operation_name(query):
+    # the name of the first operation in the document, or None if it is anonymous
+    _match = _HEADER_RE.match(strip_comments(query).strip())
+    return _match.group(2) if _match else None
+
+
+def _find_closing(text, start, open_char, close_char):
+    # index of the bracket that closes text[start], skipping over string literals
+    _depth = 0
+    _in_string = False
+    _i = start
+    while _i < len(text):
+        _c = text[_i]
+        if _in_string:
+            if _c == '\\':
+                _i += 1
+            elif _c == '"':
+                _in_string = False
+        elif _c == '"':
+            _in_string = True
+        elif _c == open_char:
+            _depth += 1
+        elif _c == close_char:
+            _depth -= 1
+            if _depth == 0:
+                return _i
+        _i += 1
+    raise SonraiAPIException("Unbalanced '{}' in GraphQL document".format(open_char))
+
+
+def split_operation(query):
+    # returns (operation type, variable definitions text, top level selection text) for a single operation
+    _doc = strip_comments(query).strip()
+    _type = operation_type(_doc)
+    _defs = ""
+
+    _header = _HEADER_RE.match(_doc)
+    _pos = _header.end() if _header else 0
+    _rest = _doc[_pos:].lstrip()
+    _pos = len(_doc) - len(_rest)
+
+    if _rest.startswith("("):
+        _end = _find_closing(_doc, _pos, "(", ")")
+        _defs = _doc[_pos + 1:_end].strip()
+        _pos = _end + 1
+
+    _open = _doc.find("{", _pos)
+    if _open == -1:
+        raise SonraiAPIException("No selection set found in GraphQL document")
+    _close = _find_closing(_doc, _open, "{", "}")
+
+    if _doc[_close + 1:].strip():
+        raise SonraiAPIException("Only documents with a single operation and no fragments can be split")
+
+    return _type, _defs, _doc[_open + 1:_close].strip()
+
+
+def variable_names(definitions):
+    # names declared in a variable definitions block, e.g. '$a: String, $b: [Int]!' -> ['a', 'b']
+    return re.findall(r'\$([_A-Za-z][_0-9A-Za-z]*)\s*:', definitions)
+
+
+def root_field(selection):
+    # (alias, field name) of the first top level field in a selection set
+    _match = _ROOT_FIELD_RE.match(selection)
+    if not _match:
+        raise SonraiAPIException("No root field found in GraphQL selection")
+    return _match.group(1), _match.group(2)
+
+
+def root_fields(selection):
+    # [(alias, field name), ...] of every top level field in a selection set, arguments, directives and
+    # sub-selections skipped.  Fragment spreads are not supported
+    _fields = []
+    _pos = 0
+    while selection[_pos:].strip(" \t\r\n,"):
+        _match = _FIELD_RE.match(selection, _pos)
+        if not _match:
+            raise SonraiAPIException("Unable to read the top level fields of the GraphQL selection")
+        _fields.append((_match.group(1), _match.group(2)))
+        _pos = _match.end()
+        while True:
+            if selection.startswith("(", _pos):
+                _pos = _find_closing(selection, _pos, "(", ")") + 1
+            else:
+                _directive = _DIRECTIVE_RE.match(selection, _pos)
+                if not _directive:
+                    break
+                _pos = _directive.end()
+            _pos = len(selection) - len(selection[_pos:].lstrip())
+        if selection.startswith("{", _pos):
+            _pos = _find_closing(selection, _pos, "{", "}") + 1
+    return _fields
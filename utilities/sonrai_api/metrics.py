@@ -0,0 +1,256 @@
+import atexit
+import os
+import sys
+import threading
+import time
+
+from sonrai_api import atomicfile, config, logger
+
+# Per query name instrumentation of the requests sent by api.execute_query and the aio client: a latency
+# histogram, response bytes, retries, GraphQL errors and rate limit waits.  The numbers are kept in memory and,
+# depending on config, written at exit as a Prometheus textfile (metrics_textfile), printed as a summary table
+# (metrics_summary) and / or sent as OpenTelemetry spans while the run goes (metrics_otel, needs opentelemetry-api).
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_stats = {}
+_stats_lock = threading.Lock()
+_started = time.time()
+_tracer = None
+_exit_registered = False
+
+
+class _QueryStats:
+    """Totals for one query name"""
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.graphql_errors = 0
+        self.retries = 0
+        self.rate_limit_waits = 0
+        self.rate_limit_wait_secs = 0.0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+
+def enabled():
+    return config.get('metrics_enabled', 1) != 0
+
+
+def _get_tracer():
+    # opentelemetry is optional, spans are only sent when metrics_otel is set and the library is installed
+    global _tracer
+    if _tracer is None:
+        _tracer = False
+        if config.get('metrics_otel', 0):
+            try:
+                from opentelemetry import trace
+                _tracer = trace.get_tracer("sonrai_api")
+            except ImportError:
+                logger.warning("metrics_otel is set but opentelemetry is not installed - pip3 install opentelemetry-api")
+    return _tracer
+
+
+class Call:
+    """One request (including its retries), created by start() and finished with done() or failed()"""
+
+    def __init__(self, query_name):
+        self.query_name = query_name
+        self.started = time.monotonic()
+        self.retries = 0
+        self.rate_limit_waits = 0
+        self.rate_limit_wait_secs = 0.0
+        _tracer = _get_tracer()
+        self.span = _tracer.start_span("sonrai_api " + query_name, attributes={"graphql.operation.name": query_name}) if _tracer else None
+
+    def retry(self):
+        self.retries += 1
+
+    def waited(self, seconds):
+        # time spent on the client side rate limit or on a 429 Retry-After
+        if seconds > 0:
+            self.rate_limit_waits += 1
+            self.rate_limit_wait_secs += seconds
+
+    def done(self, status_code, body, size):
+        _errors = len(body.get('errors') or []) if status_code == 200 and isinstance(body, dict) else 0
+        self._finish(status_code != 200, _errors, size, status_code)
+
+    def failed(self):
+        # no response at all, e.g. connection errors until the retries ran out
+        self._finish(True, 0, 0, None)
+
+    def _finish(self, failure, graphql_errors, size, status_code):
+        _elapsed = time.monotonic() - self.started
+        _register_exit()
+        with _stats_lock:
+            _s = _stats.setdefault(self.query_name, _QueryStats())
+            _s.requests += 1
+            _s.failures += 1 if failure else 0
+            _s.graphql_errors += graphql_errors
+            _s.retries += self.retries
+            _s.rate_limit_waits += self.rate_limit_waits
+            _s.rate_limit_wait_secs += self.rate_limit_wait_secs
+            _s.bytes += size
+            _s.seconds += _elapsed
+            for _i, _bound in enumerate(BUCKETS):
+                if _elapsed <= _bound:
+                    _s.buckets[_i] += 1
+                    break
+
+        if self.span is not None:
+            self.span.set_attribute("http.response.status_code", status_code or 0)
+            self.span.set_attribute("sonrai.response_bytes", size)
+            self.span.set_attribute("sonrai.retries", self.retries)
+            self.span.set_attribute("sonrai.graphql_errors", graphql_errors)
+            self.span.set_attribute("sonrai.rate_limit_wait_secs", self.rate_limit_wait_secs)
+            self.span.end()
+
+
+class _NoCall:
+    """Stand-in for Call when metrics are disabled"""
+
+    def retry(self):
+        pass
+
+    def waited(self, seconds):
+        pass
+
+    def done(self, status_code, body, size):
+        pass
+
+    def failed(self):
+        pass
+
+
+def start(query_name):
+    return Call(query_name) if enabled() else _NoCall()
+
+
+def snapshot():
+    # {query name: {"requests", "failures", "graphql_errors", "retries", "rate_limit_waits", "rate_limit_wait_secs",
+    #  "bytes", "seconds", "buckets"}} - buckets are cumulative counts, one per BUCKETS bound
+    with _stats_lock:
+        _result = {}
+        for _name, _s in _stats.items():
+            _cumulative = []
+            _total = 0
+            for _count in _s.buckets:
+                _total += _count
+                _cumulative.append(_total)
+            _result[_name] = dict(vars(_s), buckets=_cumulative)
+        return _result
+
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def prometheus_text(script=None):
+    # the metrics in the Prometheus text exposition format, labelled with the script name
+    _script = _escape(script or _script_name())
+    _lines = []
+
+    def _family(name, kind, help_text):
+        _lines.append("# HELP {} {}".format(name, help_text))
+        _lines.append("# TYPE {} {}".format(name, kind))
+
+    _stats_now = snapshot()
+    _counters = (
+        ("sonrai_api_requests_total", "requests", "Requests sent, retries of a request count once"),
+        ("sonrai_api_request_failures_total", "failures", "Requests that ended without a 200 response"),
+        ("sonrai_api_graphql_errors_total", "graphql_errors", "GraphQL errors in the responses"),
+        ("sonrai_api_retries_total", "retries", "Retries after timeouts, connection errors, 429 and 5xx responses"),
+        ("sonrai_api_rate_limit_waits_total", "rate_limit_waits", "Waits for the client rate limit or a 429 Retry-After"),
+        ("sonrai_api_rate_limit_wait_seconds_total", "rate_limit_wait_secs", "Seconds spent waiting for the rate limit"),
+        ("sonrai_api_response_bytes_total", "bytes", "Response body bytes received"),
+    )
+    for _metric, _field, _help in _counters:
+        _family(_metric, "counter", _help)
+        for _name, _s in sorted(_stats_now.items()):
+            _lines.append('{}{{script="{}",query_name="{}"}} {}'.format(_metric, _script, _escape(_name), _s[_field]))
+
+    _family("sonrai_api_request_duration_seconds", "histogram", "Time from the first attempt of a request to its response")
+    for _name, _s in sorted(_stats_now.items()):
+        _labels = 'script="{}",query_name="{}"'.format(_script, _escape(_name))
+        for _bound, _count in zip(BUCKETS, _s["buckets"]):
+            _lines.append('sonrai_api_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(_labels, _bound, _count))
+        _lines.append('sonrai_api_request_duration_seconds_bucket{{{},le="+Inf"}} {}'.format(_labels, _s["requests"]))
+        _lines.append('sonrai_api_request_duration_seconds_sum{{{}}} {:.6f}'.format(_labels, _s["seconds"]))
+        _lines.append('sonrai_api_request_duration_seconds_count{{{}}} {}'.format(_labels, _s["requests"]))
+
+    _family("sonrai_api_last_run_timestamp_seconds", "gauge", "When the run that wrote this file finished")
+    _lines.append('sonrai_api_last_run_timestamp_seconds{{script="{}"}} {:.0f}'.format(_script, time.time()))
+    return "\n".join(_lines) + "\n"
+
+
+def write_textfile(path):
+    # replaced atomically, the node exporter never reads a partial file
+    atomicfile.write(path, prometheus_text(), mode=0o644)
+
+
+def summary():
+    # table of the query names by total time, the slowest first
+    _stats_now = snapshot()
+    _rows = [("query name", "requests", "total s", "avg s", "p95 s", "MB", "retries", "errors", "rl waits")]
+    for _name, _s in sorted(_stats_now.items(), key=lambda _item: -_item[1]["seconds"]):
+        _rows.append((
+            _name,
+            str(_s["requests"]),
+            "{:.2f}".format(_s["seconds"]),
+            "{:.3f}".format(_s["seconds"] / _s["requests"]),
+            _percentile_bound(_s, 0.95),
+            "{:.2f}".format(_s["bytes"] / 1048576),
+            str(_s["retries"]),
+            str(_s["graphql_errors"] + _s["failures"]),
+            "{} ({:.1f}s)".format(_s["rate_limit_waits"], _s["rate_limit_wait_secs"]),
+        ))
+    _widths = [max(len(_row[_i]) for _row in _rows) for _i in range(len(_rows[0]))]
+    _lines = ["sonrai_api requests of this run ({:.1f}s)".format(time.time() - _started)]
+    for _row in _rows:
+        _lines.append("  ".join(_cell.ljust(_w) if _i == 0 else _cell.rjust(_w) for _i, (_cell, _w) in enumerate(zip(_row, _widths))))
+    return "\n".join(_lines)
+
+
+def _percentile_bound(stats, fraction):
+    # the histogram bucket the percentile falls in, as "<= bound"
+    _wanted = stats["requests"] * fraction
+    for _bound, _count in zip(BUCKETS, stats["buckets"]):
+        if _count >= _wanted:
+            return "<={}".format(_bound)
+    return ">{}".format(BUCKETS[-1])
+
+
+def _script_name():
+    return os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+
+
+def _register_exit():
+    global _exit_registered
+    if not _exit_registered:
+        _exit_registered = True
+        atexit.register(_at_exit)
+
+
+def _at_exit():
+    # {script} in metrics_textfile is replaced by the script name, so each cron job keeps its own file
+    if not _stats:
+        return
+    _path = config.get('metrics_textfile')
+    if _path:
+        _path = os.path.expanduser(_path.replace("{script}", _script_name()))
+        try:
+            write_textfile(_path)
+            logger.debug("metrics written to {}".format(_path))
+        except OSError as e:
+            logger.warning("unable to write the metrics to {}: {}".format(_path, e))
+    if config.get('metrics_summary', 0):
+        print(summary(), file=sys.stderr)
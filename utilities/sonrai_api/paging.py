@@ -0,0 +1,91 @@
+import hashlib
+import json
+import os
+import threading
+
+from sonrai_api import atomicfile, config, logger, graphql
+
+# Adaptive page sizing for api.paginate().
+# The page size is halved when the server answers with the GRPC query size limit error, drops to what the server
+# returned when it caps pages, and is grown again while pages come back faster than config['page_latency_target_secs'].
+# The size a query settles on, and the smallest size that failed, are remembered in config['page_size_store'] so the
+# next run of the same query starts there.  With learn=False only the halving and capping apply, so the same query always asks for the same pages.
+
+_store_lock = threading.Lock()
+
+
+def _store_path():
+    return os.path.expanduser(config.get('page_size_store', '/tmp/sonrai/page_sizes.json'))
+
+
+def _load_store():
+    try:
+        with open(_store_path(), "r") as _file:
+            return json.load(_file)
+    except (OSError, ValueError):
+        return {}
+
+
+class PageSizer:
+    """Tracks the page size of one paginated query"""
+
+    def __init__(self, query, page_size, target_latency=None, learn=True):
+        self.learn = learn
+        self.key = hashlib.sha256(graphql.normalize(query).encode("utf-8")).hexdigest()
+        self.minimum = int(config.get('page_size_min', 10))
+        self.maximum = max(int(config.get('page_size_max', 10000)), page_size)
+        self.target_latency = float(target_latency or config.get('page_latency_target_secs', 10))
+        _stored = (_load_store().get(self.key) if learn else None) or {}
+        self.ceiling = _stored.get("ceiling")
+        self.initial = int(_stored.get("size", page_size))
+        self.size = self.initial
+        if self.size != page_size:
+            logger.debug("starting with remembered page size {} instead of {}".format(self.size, page_size))
+
+    def limit_reached(self):
+        # called when a page of self.size hit the GRPC limit; returns False when it cannot shrink any further
+        if self.size <= self.minimum:
+            return False
+        self.ceiling = self.size if self.ceiling is None else min(self.ceiling, self.size)
+        self.size = max(self.minimum, self.size // 2)
+        logger.warning("query size limit reached, retrying with a page size of {}".format(self.size))
+        return True
+
+    def page_capped(self, returned):
+        # a page came back with fewer items than asked although more remain: the server caps the page size
+        if returned < self.minimum or returned >= self.size:
+            return
+        self.ceiling = returned + 1 if self.ceiling is None else min(self.ceiling, returned + 1)
+        self.size = returned
+        logger.debug("server returned {} items per page, using that as the page size".format(returned))
+
+    def page_done(self, latency):
+        # grow after a fast page; once a size has failed, only move half way towards it and stop within 10%
+        if not self.learn or latency >= self.target_latency:
+            return
+        if self.ceiling is None:
+            _next = min(self.size * 2, self.maximum)
+        elif self.size * 10 >= self.ceiling * 9:
+            return
+        else:
+            _next = min((self.size + self.ceiling) // 2, self.maximum)
+        if _next > self.size:
+            logger.debug("page took {:.2f}s, growing page size to {}".format(latency, _next))
+            self.size = _next
+
+    def save(self):
+        if not self.learn:
+            return
+        if self.size != self.initial:
+            logger.info("settled on a page size of {} for this query".format(self.size))
+
+        with _store_lock:
+            _sizes = _load_store()
+            _entry = {"size": self.size, "ceiling": self.ceiling}
+            if _sizes.get(self.key) == _entry:
+                return
+            _sizes[self.key] = _entry
+            try:
+                atomicfile.write(_store_path(), json.dumps(_sizes))
+            except OSError as e:
+                logger.debug("unable to store page size: {}".format(e))
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+
+from sonrai_api import config, logger, graphql, filelock
+
+# Client side token-bucket rate limiting for every request sent to the GraphQL endpoint.
+# Reads and mutations have separate budgets (requests per second, 0 = unlimited).  With the "file" backend the
+# bucket state lives in config['rate_limit_dir'] behind a file lock, so every script on the host shares one budget.
+
+
+class TokenBucket:
+    """In-process bucket, shared by all threads"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # takes one token and returns how long the caller has to wait before using it
+        with self._lock:
+            self.tokens, self.updated, _wait = _take(self.tokens, self.updated, time.monotonic(), self.rate, self.burst)
+            return _wait
+
+
+class FileTokenBucket:
+    """Bucket stored in a file, shared by all processes that use the same path"""
+
+    def __init__(self, rate, burst, path):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self.path = path
+
+    def reserve(self):
+        with filelock.locked(self.path) as _file:
+            _file.seek(0)
+            try:
+                _state = json.loads(_file.read() or "{}")
+            except ValueError:
+                _state = {}
+            # wall clock time, monotonic clocks are not comparable between processes
+            _tokens, _updated, _wait = _take(
+                _state.get("tokens", self.burst), _state.get("updated", time.time()), time.time(), self.rate, self.burst
+            )
+            _file.seek(0)
+            _file.truncate()
+            _file.write(json.dumps({"tokens": _tokens, "updated": _updated}))
+            _file.flush()
+            return _wait
+
+
+def _take(tokens, updated, now, rate, burst):
+    # refill for the time elapsed, then take one token; a negative balance is time owed by the caller
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate) - 1
+    _wait = 0.0 if tokens >= 0 else -tokens / rate
+    return tokens, now, _wait
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _bucket(kind):
+    # one bucket per kind ("query" / "mutation"), created from config on first use; None when unlimited
+    with _buckets_lock:
+        if kind not in _buckets:
+            _key = 'rate_limit_mutations_per_sec' if kind == "mutation" else 'rate_limit_reads_per_sec'
+            _rate = float(config.get(_key, 0) or 0)
+            _burst = int(config.get('rate_limit_burst', 10))
+            if _rate <= 0:
+                _buckets[kind] = None
+            elif config.get('rate_limit_backend', 'memory') == 'file':
+                _dir = os.path.expanduser(config.get('rate_limit_dir', '/tmp/sonrai/ratelimit'))
+                _buckets[kind] = FileTokenBucket(_rate, _burst, os.path.join(_dir, kind + ".bucket"))
+            else:
+                _buckets[kind] = TokenBucket(_rate, _burst)
+        return _buckets[kind]
+
+
+def request_kind(query):
+    # which budget a request is charged to
+    return "mutation" if graphql.operation_type(query) == "mutation" else "query"
+
+
+def reserve(kind):
+    # seconds the caller must wait before sending a request of this kind
+    _limiter = _bucket(kind)
+    if _limiter is None:
+        return 0.0
+    return _limiter.reserve()
+
+
+def acquire(kind):
+    # blocks until the request may be sent; returns the time spent waiting
+    _wait = reserve(kind)
+    if _wait > 0:
+        logger.debug("rate limit reached, waiting {:.2f}s".format(_wait))
+        time.sleep(_wait)
+    return _wait
+
+
+async def acquire_async(kind):
+    import asyncio
+
+    _limiter = _bucket(kind)
+    if isinstance(_limiter, FileTokenBucket):
+        # the file lock blocks while other processes hold it, keep it off the event loop
+        _wait = await asyncio.get_running_loop().run_in_executor(None, _limiter.reserve)
+    else:
+        _wait = reserve(kind)
+    if _wait > 0:
+        logger.debug("rate limit reached, waiting {:.2f}s".format(_wait))
+        await asyncio.sleep(_wait)
+    return _wait
@@ -0,0 +1,142 @@
+import email.utils
+import random
+import threading
+import time
+
+from sonrai_api import config, logger, SonraiAPIException
+
+# One retry policy shared by every query in the process (api.execute_query and the aio client):
+#   - exponential backoff with full jitter between attempts
+#   - Retry-After is honoured on 429 / 503 responses
+#   - a per-run retry budget, so a sick endpoint cannot turn every call into N retries
+#   - a circuit breaker that stops sending requests for a cooldown after repeated failures
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class SonraiCircuitOpenException(SonraiAPIException):
+    """Raised when requests are refused because the circuit breaker is open"""
+    pass
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and refuses requests for `cooldown` seconds"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        # seconds until the breaker lets a request through again (0 when closed or half-open)
+        with self._lock:
+            if self.opened_at is None:
+                return 0
+            return max(0, self.opened_at + self.cooldown - time.time())
+
+    def before_request(self):
+        _wait = self.remaining()
+        if _wait > 0:
+            raise SonraiCircuitOpenException("Circuit breaker open - not contacting Sonrai for another {:.0f}s".format(_wait))
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("circuit breaker closed, Sonrai is responding again")
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.error("circuit breaker opened after {} consecutive failures".format(self.failures))
+                # a failure after the cooldown re-opens it straight away
+                self.opened_at = time.time()
+
+
+class RetryPolicy:
+    """Decides whether and how long to wait before retrying a failed request"""
+
+    def __init__(self, max_retries=10, base_delay=1.0, max_delay=60.0, budget=100, breaker=None):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.breaker = breaker or CircuitBreaker(0, 0)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def retryable_status(status_code, body=None):
+        # the GRPC query size error is deterministic, retrying it only wastes time
+        if "Unexpected exception while fetching Grpc data" in str(body):
+            return False
+        return status_code in RETRY_STATUS_CODES
+
+    def allow_retry(self, attempt):
+        # attempt is the number of retries already made for this request; consumes one unit of the run budget
+        if attempt >= self.max_retries:
+            return False
+        with self._lock:
+            if self.budget <= 0:
+                logger.error("retry budget for this run is exhausted, not retrying")
+                return False
+            self.budget -= 1
+            return True
+
+    def delay(self, attempt, retry_after=None):
+        # full jitter: anywhere between 0 and the exponential cap, but never less than Retry-After
+        # or the time left before the circuit breaker lets requests through again
+        _delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            _delay = max(_delay, retry_after)
+        return max(_delay, self.breaker.remaining())
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_default_policy = None
+_default_lock = threading.Lock()
+
+
+def default_policy():
+    # process-wide policy built from config on first use
+    global _default_policy
+    if _default_policy is None:
+        with _default_lock:
+            if _default_policy is None:
+                _default_policy = RetryPolicy(
+                    max_retries=int(config['query_retries']),
+                    base_delay=float(config.get('retry_base_delay_secs', 1)),
+                    max_delay=float(config.get('retry_max_delay_secs', 60)),
+                    budget=int(config.get('retry_budget', 100)),
+                    breaker=CircuitBreaker(
+                        int(config.get('circuit_breaker_threshold', 5)),
+                        float(config.get('circuit_breaker_cooldown_secs', 60))
+                    )
+                )
+    return _default_policy
+
+
+def set_default_policy(policy):
+    # replace the shared policy, e.g. with different limits for a long running export
+    global _default_policy
+    with _default_lock:
+        _default_policy = policy
@@ -2,27 +2,24 @@ import time
 import datetime
 import os
 import logging
-import jwt
 import sys
 import json
-import requests
-import readline
+import threading
 
 from os import path
 from datetime import datetime
 from pathlib import Path
+from sonrai_api import atomicfile, config, filelock, SonraiAPIException
+
+# The token is read, decoded and verified on first use (get_api_token), not when the library is imported,
+# so scripts can parse --help or do a dry run without touching the token store or the network.
+# jwt, requests and readline are imported only when they are needed for the same reason.
 
 # get the calling scripts and this library's path
 script_path = os.path.dirname(sys.argv[0])
 lib_path = Path(__file__).parent.absolute()
 
 
-# define Python user-defined exceptions
-class SonraiAPIException(Exception):
-    """Base class for other exceptions"""
-    pass
-
-
 def prompt_for_new_token():
     """Prompt user to generate and enter a new Sonrai token."""
     tokenquery = '''
@@ -38,12 +35,14 @@ def prompt_for_new_token():
     '''
     logger.error("You can generate a new token at https://app.sonraisecurity.com/App/GraphExplorer with the query above.")
     logger.error(tokenquery)
+    import readline  # noqa: F401 - line editing for the prompt below
     return input('Enter Sonrai User Token (no quotes): ')
 
 
 # globals
 logger = logging.getLogger("sonrai-token")
 token = str()
+_claims = None
 
 # Create the Logger for use with all modules
 # https://docs.python.org/3/library/logging.html#logrecord-objects
@@ -57,17 +56,6 @@ logging.basicConfig(
 level = logging.getLevelName('ERROR')
 logger.setLevel(level)
 
-# Constants from config
-try:
-    with open('sonrai_api/config.json') as json_file:
-        config = json.load(json_file)
-except json.decoder.JSONDecodeError:
-    logging.error("Unable to parse the config.json file")
-    exit(255)
-except FileNotFoundError:
-    logging.error("Unable to find the config.json file")
-    exit(254)
-
 # check for same script
 if config['error_240_override'] == 0:
     if str(script_path).lower().strip() == str(lib_path).lower().strip():
@@ -78,7 +66,7 @@ if config['error_240_override'] == 0:
 _token_store = os.environ.get("SONRAI_API_TOKENSTORE", config['token_store'])
 _token_file = os.environ.get("SONRAI_API_TOKENFILE", config['token_file'])
 _env_token = os.environ.get("TOKEN", None)
-_token_refresh_secs = os.environ.get("SONRAI_TOKEN_REFRESH_SECS", config['token_refresh_threshold_secs'])
+_token_refresh_secs = int(os.environ.get("SONRAI_TOKEN_REFRESH_SECS", config['token_refresh_threshold_secs']))
 _api_server = os.environ.get("SONRAI_API_SERVER", None)
 _jwt_options = {"verify_iat": True, "verify_nbf": True, "verify_exp": True, "verify_iss": True, "verify_aud": False, "verify_signature": False}
 
@@ -87,25 +75,177 @@ level = logging.getLevelName(config['sonrai-token-log-level'])
 logger.setLevel(level)
 
 
+def _token_path():
+    return os.path.join(_token_store, _token_file)
+
+
+def _env_store():
+    return bool(_env_token) or config['token_store'] == 'env'
+
+
 def store_token():
-    if _env_token or config['token_store'] == 'env':
+    if _env_store():
         logger.debug("Storing token in ENV")
         os.environ['TOKEN'] = str(token).strip()
     else:
-        logger.debug("Storing token in " + os.path.join(_token_store, _token_file))
-        if not (os.path.exists(_token_store)):
-            os.mkdir(_token_store)
-        with open(os.path.join(_token_store, _token_file), "w") as token_dest:
-            token_dest.write(str(token).strip())
-            token_dest.close()
+        logger.debug("Storing token in " + _token_path())
+        # replaced atomically, a reader never sees a partly written token
+        atomicfile.write(_token_path(), str(token).strip(), dir_mode=0o700, prefix="." + _token_file)
+
+
+def _read_stored_token():
+    try:
+        with open(_token_path(), "r") as token_source:
+            return token_source.read().strip()
+    except OSError:
+        return None
+
+
+def _expiry(value):
+    # exp claim of any token, 0 when it cannot be decoded
+    import jwt
+    try:
+        return jwt.decode(value, options={"verify_signature": False}).get('exp', 0)
+    except jwt.exceptions.InvalidTokenError:
+        return 0
+
+
+def renew_stored_token():
+    # renew while holding a lock on the token store.  Processes that waited for the lock find the token the
+    # first one stored and use it instead of renewing again
+    global token
+    if _env_store():
+        renew_token()
+        return
+
+    with filelock.locked(_token_path() + ".lock"):
+        _stored = _read_stored_token()
+        if _stored and _stored != token and _expiry(_stored) > _expiry(token):
+            logger.debug("token was renewed by another process, using it")
+            token = _stored
+            return
+        renew_token()
+
+
+def decode_token():
+    # the claims of the current token; the jwt is only decoded again after the token changes
+    global _claims
+    if _claims is None or _claims[0] != token:
+        import jwt
+        _claims = (token, jwt.decode(token, options=_jwt_options, algorithms=["RS256"]))
+    return _claims[1]
+
+
+class TokenManager:
+    """Owns the current token: loads it on first use, renews it ahead of expiry and hands out the bearer"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._claims = None
+        self._broker = False
+        self._refresher = None
+        self._stop = threading.Event()
+
+    def claims(self):
+        # decoded token with org, env and sonrai_url added - loaded and verified the first time it is needed,
+        # from a running sonrai-authd broker when there is one, otherwise from the token store
+        if self._claims is None:
+            with self._lock:
+                if self._claims is None and not self._load_from_broker():
+                    self._load_from_file()
+        return self._claims
+
+    def expires_in(self):
+        return self.claims().get('exp', 0) - time.time()
+
+    def bearer(self):
+        # the token to send with a request.  A token from the broker is fetched again once it nears expiry
+        # (the broker renews it); without a background refresh the token is renewed inline
+        self.claims()
+        if self._broker and self.expires_in() < _token_refresh_secs:
+            with self._lock:
+                if self.expires_in() < _token_refresh_secs and not self._load_from_broker():
+                    self._load_from_file()
+        elif self._refresher is None and 0 < self.expires_in() < _token_refresh_secs:
+            self.refresh(stale=token)
+        return token
+
+    def refresh(self, stale=None):
+        # renew the token.  stale is the bearer a failed request was sent with - when another worker has
+        # already replaced it there is nothing left to do.  raises SonraiAPIException if renewal fails
+        with self._lock:
+            if stale is not None and stale != token:
+                return token
+            if self._broker:
+                if self._load_from_broker("refresh", stale or token):
+                    return token
+                self._load_from_file()
+                if stale is not None and stale != token:
+                    return token
+            renew_stored_token()
+            self._claims = verify_token()
+            return token
+
+    def _load_from_broker(self, op="get", stale=None):
+        global token
+        from sonrai_api import authd
+
+        _response = authd.request(op, stale)
+        if _response is None:
+            if self._broker:
+                logger.debug("auth broker went away, using the token store")
+            return False
+        _claims = _response['claims']
+        _claims['human_expires'] = datetime.fromtimestamp(_claims.get('exp', 0))
+        token = _response['token']
+        self._claims = _claims
+        self._broker = True
+        return True
+
+    def _load_from_file(self):
+        self._broker = False
+        load_token()
+        self._claims = verify_token()
+        self._start_refresher()
+
+    def stop(self):
+        self._stop.set()
+
+    def _start_refresher(self):
+        if config.get('token_background_refresh', 1) == 0 or self._refresher is not None:
+            return
+        self._refresher = threading.Thread(target=self._refresh_loop, name="sonrai-token-refresh", daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        # wake up when the token enters the renewal window; at least a minute between attempts
+        while not self._stop.wait(max(60, self.expires_in() - _token_refresh_secs)):
+            _remaining = self.expires_in()
+            if _remaining <= 0:
+                logger.error("token expired before it could be renewed")
+                return
+            if _remaining < _token_refresh_secs:
+                try:
+                    self.refresh()
+                    logger.debug("token renewed in the background")
+                except SonraiAPIException as e:
+                    logger.error("background token renewal failed - {}".format(e))
+
+
+manager = TokenManager()
+
+
+def get_api_token():
+    return manager.claims()
 
 
 def verify_token():
     # Decode token, parse expiration date, and calculate time remaining
     # if within expiration time > 0, renew token
     global token
+    import jwt
     try:
-        decoded_token = jwt.decode(token, options=_jwt_options, algorithms=["RS256"])
+        decoded_token = dict(decode_token())
 
     except jwt.exceptions.ExpiredSignatureError:
         logger.error("Your token has expired. Please provide a new one.")
@@ -127,6 +267,10 @@ def verify_token():
             os.remove(os.path.join(_token_store, _token_file))
         raise SonraiAPIException("Invalid Token")
 
+    if token_expiring():
+        renew_stored_token()
+        decoded_token = dict(decode_token())
+
     # ORG and ORGS
     decoded_token['org'] = decoded_token['https://sonraisecurity.com/org']
     decoded_token['orgs'] = decoded_token['https://sonraisecurity.com/orgs']
@@ -140,15 +284,12 @@ def verify_token():
     logger.debug("Token Expires: {}".format(datetime.fromtimestamp(decoded_token.get('exp', 0))))
     decoded_token['human_expires'] = datetime.fromtimestamp(decoded_token.get('exp', 0))
 
-    if token_expiring():
-        renew_token()
-
     return decoded_token
 
 
 def get_graph_url():
     if _api_server is None:
-        decoded_token = jwt.decode(token, options=_jwt_options, algorithms=["RS256"])
+        decoded_token = decode_token()
         org = decoded_token['https://sonraisecurity.com/org']
         env = decoded_token['https://sonraisecurity.com/env']
 
@@ -164,7 +305,11 @@ def get_graph_url():
     else:
         s = str(_api_server).strip()
 
-    URL = "https://{}/graphql".format(s)
+    # SONRAI_API_SERVER may carry its own scheme, e.g. http://127.0.0.1:8080 for a local mock server
+    if "://" in s:
+        URL = "{}/graphql".format(s.rstrip("/"))
+    else:
+        URL = "https://{}/graphql".format(s)
     logger.debug("API server: " + URL)
 
     return URL
@@ -197,6 +342,7 @@ def renew_token():
         }
         logger.debug("using proxy server: {}".format(config['verify_ssl']))
 
+    import requests
     try:
         response = requests.post(
             get_graph_url(),
@@ -224,7 +370,7 @@ def token_expiring():
     global token
 
     # Decode token, parse expiration date, and calculate time remaining
-    decoded_token = jwt.decode(token, options=_jwt_options, algorithms=["RS256"])
+    decoded_token = decode_token()
     current_time = time.time()
     remaining = decoded_token['exp'] - current_time
     logger.debug("expiry:{expiry} || current: {current} || remaining: {remaining}s".format(expiry=str(decoded_token['exp']), current=str(int(current_time)), remaining=str(int(remaining))))
@@ -246,7 +392,7 @@ def token_expired():
     global token
 
     # Decode token, parse expiration date, and calculate time remaining
-    decoded_token = jwt.decode(token, options=_jwt_options, algorithms=["RS256"])
+    decoded_token = decode_token()
     current_time = time.time()
     remaining = decoded_token['exp'] - current_time
 
@@ -258,8 +404,13 @@ def token_expired():
     return False
 
 
-# Env token over stored token
-if not _env_token:
+def load_token():
+    # Env token over stored token
+    global token
+    if _env_token:
+        token = _env_token.strip()
+        return
+
     # Check for token in token store file.
     tokenCheck = path.exists(os.path.join(_token_store, _token_file))
 